@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# LoRa time on air, EU868 duty cycle limits and FUOTA campaign planning.
+#
+# This module has no device dependencies so that the patch builder on the
+# server can import it and split patches exactly like the device expects.
+
+# EU868 data rates: DR -> (spreading factor, bandwidth in kHz)
+EU868_DATA_RATES = {
+    0: (12, 125),
+    1: (11, 125),
+    2: (10, 125),
+    3: (9, 125),
+    4: (8, 125),
+    5: (7, 125),
+    6: (7, 250),
+}
+
+# EU868 sub-bands: (lowest frequency, highest frequency, duty cycle)
+EU868_SUB_BANDS = (
+    (863000000, 865000000, 0.001),
+    (865000000, 868000000, 0.01),
+    (868000000, 868600000, 0.01),
+    (868700000, 869200000, 0.001),
+    (869400000, 869650000, 0.1),
+    (869700000, 870000000, 0.01),
+)
+
+# MHDR + FHDR (without options) + FPort + MIC
+LORAWAN_OVERHEAD = 13
+
+PREAMBLE_SYMBOLS = 8
+CODING_RATE = 1  # 4/5
+
+
+def time_on_air(payload_size, sf, bw_khz, cr = CODING_RATE, preamble = PREAMBLE_SYMBOLS,
+                crc = True, implicit_header = False):
+    # Time on air in ms of a LoRa frame with payload_size bytes of PHY payload
+    t_sym = (1 << sf) / bw_khz
+    # Low data rate optimization is mandatory when a symbol lasts 16 ms or more
+    de = 1 if t_sym >= 16 else 0
+
+    t_preamble = (preamble + 4.25) * t_sym
+
+    num = 8 * payload_size - 4 * sf + 28 + (16 if crc else 0) - (20 if implicit_header else 0)
+    den = 4 * (sf - 2 * de)
+    n_payload = 8 + max(-(-num // den) * (cr + 4), 0)
+
+    return t_preamble + n_payload * t_sym
+
+
+def uplink_time_on_air(app_payload_size, dr):
+    # Time on air in ms of a LoRaWAN uplink carrying app_payload_size bytes
+    sf, bw = EU868_DATA_RATES[dr]
+    return time_on_air(app_payload_size + LORAWAN_OVERHEAD, sf, bw)
+
+
+def downlink_time_on_air(app_payload_size, dr):
+    # Downlinks carry no payload CRC
+    sf, bw = EU868_DATA_RATES[dr]
+    return time_on_air(app_payload_size + LORAWAN_OVERHEAD, sf, bw, crc = False)
+
+
+def sub_band(frequency):
+    # Index of the EU868 sub-band containing frequency, or None
+    for idx, band in enumerate(EU868_SUB_BANDS):
+        if band[0] <= frequency <= band[1]:
+            return idx
+    return None
+
+
+def duty_cycle(frequency):
+    band = sub_band(frequency)
+    if band is None:
+        return 0.01
+    return EU868_SUB_BANDS[band][2]
+
+
+def off_time(toa_ms, frequency):
+    # Time in ms the sub-band must stay silent after a frame of toa_ms
+    dc = duty_cycle(frequency)
+    return toa_ms / dc - toa_ms
+
+
+# EU868 maximum application payload (N) per DR, without FOpts
+EU868_MAX_PAYLOAD = {
+    0: 51,
+    1: 51,
+    2: 51,
+    3: 115,
+    4: 222,
+    5: 222,
+    6: 222,
+}
+
+
+def max_payload(dr):
+    return EU868_MAX_PAYLOAD[dr]
+
+
+# Framing of a patch fragment: b'$OTA,6,' + data + b',*'
+FRAGMENT_OVERHEAD = 9
+
+
+def session_overhead(session):
+    # Sessions other than 0 are written after the type: b'$OTA,6:2,'
+    if not session:
+        return 0
+    return len(str(session)) + 1
+
+
+def fragment_size(dr, session = 0):
+    # Patch bytes per fragment so that every fragment fills the frame
+    return max_payload(dr) - FRAGMENT_OVERHEAD - session_overhead(session)
+
+
+def fragment_count(patch_size, dr):
+    size = fragment_size(dr)
+    return (patch_size + size - 1) // size
+
+
+def campaign_duration(patch_size, dr, frequency):
+    # Shortest time in ms to send patch_size bytes of fragments as downlinks
+    # on frequency, limited by the duty cycle of the gateway
+    count = fragment_count(patch_size, dr)
+    if count == 0:
+        return 0
+
+    size = fragment_size(dr)
+    last = patch_size - (count - 1) * size
+    full_toa = downlink_time_on_air(size + FRAGMENT_OVERHEAD, dr)
+    last_toa = downlink_time_on_air(last + FRAGMENT_OVERHEAD, dr)
+
+    dc = duty_cycle(frequency)
+    return (count - 1) * full_toa / dc + last_toa
+
+
+# Demodulation floor in dB per spreading factor
+REQUIRED_SNR = {
+    7: -7.5,
+    8: -10.0,
+    9: -12.5,
+    10: -15.0,
+    11: -17.5,
+    12: -20.0,
+}
+
+
+def fastest_dr(snr, margin, max_dr = 5):
+    # Fastest 125 kHz DR whose demodulation floor plus margin is below snr
+    for dr in range(max_dr, 0, -1):
+        sf = EU868_DATA_RATES[dr][0]
+        if REQUIRED_SNR[sf] + margin <= snr:
+            return dr
+    return 0
@@ -1 +1,9 @@
 # boot.py -- run on boot-up
+import journal
+import slots
+
+# Finish or roll back an update interrupted by a reset
+journal.recover()
+
+# Run main.py from the active A/B slot
+slots.boot()
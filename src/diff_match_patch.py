@@ -35,6 +35,7 @@ Applies the patch onto another text, allowing for errors.
 
 __author__ = 'fraser@google.com (Neil Fraser)'
 
+import array
 import math
 import ure
 import sys
@@ -76,9 +77,10 @@ class diff_match_patch:
     # Multiple short patches (using native ints) are much faster than long ones.
     self.Match_MaxBits = 32
 
-    self._hexdig = '0123456789ABCDEFabcdef'
-    self._hextochr = dict((a+b, chr(int(a+b,16)))
-                   for a in self._hexdig for b in self._hexdig)
+  # Decoding table of unquote, shared by all instances and only built the
+  # first time a quoted character is met.
+  _hexdig = '0123456789ABCDEFabcdef'
+  _hextochr = None
 
   #  DIFF FUNCTIONS
 
@@ -1252,11 +1254,25 @@ class diff_match_patch:
       return (text, [])
 
     # Deep copy the patches so that no changes are made to originals.
-    patches = self.patch_deepCopy(patches)
+    return self.patch_applyInPlace(self.patch_deepCopy(patches), text)
 
-    nullPadding = self.patch_addPadding(patches)
+  def patch_applyInPlace(self, patches, text):
+    """Same as patch_apply, but the patches are consumed instead of copied.
+    Each patch is padded, split and applied in turn, so a patch_list only
+    builds the patch being applied.
+
+    Args:
+      patches: Array of Patch objects, which is emptied, or a patch_list.
+      text: Old text.
+
+    Returns:
+      Two element Array, containing the new text and an array of boolean values.
+    """
+    if not patches:
+      return (text, [])
+
+    nullPadding = self.patch_nullPadding()
     text = nullPadding + text + nullPadding
-    self.patch_splitMax(patches)
 
     # delta keeps track of the offset between the expected and actual location
     # of the previous patch.  If there are patches expected at positions 10 and
@@ -1264,67 +1280,139 @@ class diff_match_patch:
     # has an effective expected position of 22.
     delta = 0
     results = []
-    for patch in patches:
-      expected_loc = patch.start2 + delta
-      text1 = self.diff_text1(patch.diffs)
-      end_loc = -1
-      if len(text1) > self.Match_MaxBits:
-        # patch_splitMax will only provide an oversized pattern in the case of
-        # a monster delete.
-        start_loc = self.match_main(text, text1[:self.Match_MaxBits],
-                                    expected_loc)
-        if start_loc != -1:
-          end_loc = self.match_main(text, text1[-self.Match_MaxBits:],
-              expected_loc + len(text1) - self.Match_MaxBits)
-          if end_loc == -1 or start_loc >= end_loc:
-            # Can't find valid trailing context.  Drop this patch.
-            start_loc = -1
+    last = len(patches) - 1
+    for x in range(last + 1):
+      if isinstance(patches, patch_list):
+        patch = patches.patch(x)
       else:
-        start_loc = self.match_main(text, text1, expected_loc)
-      if start_loc == -1:
-        # No match found.  :(
-        results.append(False)
-        # Subtract the delta for this failed patch from subsequent patches.
-        delta -= patch.length2 - patch.length1
-      else:
-        # Found a match.  :)
-        results.append(True)
-        delta = start_loc - expected_loc
-        if end_loc == -1:
-          text2 = text[start_loc : start_loc + len(text1)]
-        else:
-          text2 = text[start_loc : end_loc + self.Match_MaxBits]
-        if text1 == text2:
-          # Perfect match, just shove the replacement text in.
-          text = (text[:start_loc] + self.diff_text2(patch.diffs) +
-                      text[start_loc + len(text1):])
-        else:
-          # Imperfect match.
-          # Run a diff to get a framework of equivalent indices.
-          diffs = self.diff_main(text1, text2, False)
-          if (len(text1) > self.Match_MaxBits and
-              self.diff_levenshtein(diffs) / float(len(text1)) >
-              self.Patch_DeleteThreshold):
-            # The end points match, but the content is unacceptably bad.
-            results[-1] = False
-          else:
-            self.diff_cleanupSemanticLossless(diffs)
-            index1 = 0
-            for (op, data) in patch.diffs:
-              if op != self.DIFF_EQUAL:
-                index2 = self.diff_xIndex(diffs, index1)
-              if op == self.DIFF_INSERT:  # Insertion
-                text = text[:start_loc + index2] + data + text[start_loc +
-                                                               index2:]
-              elif op == self.DIFF_DELETE:  # Deletion
-                text = text[:start_loc + index2] + text[start_loc +
-                    self.diff_xIndex(diffs, index1 + len(data)):]
-              if op != self.DIFF_DELETE:
-                index1 += len(data)
+        patch = patches[x]
+        patches[x] = None
+      self.patch_padPatch(patch, nullPadding, x == 0, x == last)
+      split = [patch]
+      self.patch_splitMax(split)
+      for patch in split:
+        (text, delta) = self.patch_applyOne(patch, text, delta, results)
+    if not isinstance(patches, patch_list):
+      del patches[:]
+
     # Strip the padding off.
     text = text[len(nullPadding):-len(nullPadding)]
     return (text, results)
 
+  def patch_applyExact(self, patches, text):
+    """Merge a set of patches onto the exact text they were made from.
+    No fuzzy matching is done, a patch whose text is not found at its
+    expected location is not applied.
+
+    Args:
+      patches: Array of Patch objects or a patch_list, left unchanged.
+      text: Old text.
+
+    Returns:
+      Two element Array, containing the new text and an array of boolean values.
+    """
+    results = []
+    # Patch locations include the length changes of the previous patches and
+    # the context of a patch may hold text inserted by them, so the patches
+    # are applied in turn to the evolving text.  delta is the length change
+    # of the patches that were not applied.
+    delta = 0
+    for x in range(len(patches)):
+      if isinstance(patches, patch_list):
+        patch = patches.patch(x)
+      else:
+        patch = patches[x]
+      text1 = self.diff_text1(patch.diffs)
+      text2 = self.diff_text2(patch.diffs)
+      loc = patch.start2 + delta
+      if loc < 0 or text[loc:loc + len(text1)] != text1:
+        results.append(False)
+        delta -= len(text2) - len(text1)
+        continue
+      results.append(True)
+      text = text[:loc] + text2 + text[loc + len(text1):]
+    return (text, results)
+
+  def patch_applyOne(self, patch, text, delta, results):
+    """Apply one padded patch to the padded text.
+    Intended to be called only from within patch_applyInPlace.
+
+    Args:
+      patch: Patch object.
+      text: Padded text.
+      delta: Offset between the expected and actual location of the previous
+          patch.
+      results: Array the outcome of the patch is appended to.
+
+    Returns:
+      Tuple of the new text and the new delta.
+    """
+    expected_loc = patch.start2 + delta
+    text1 = self.diff_text1(patch.diffs)
+    end_loc = -1
+    if len(text1) > self.Match_MaxBits:
+      # patch_splitMax will only provide an oversized pattern in the case of
+      # a monster delete.
+      start_loc = self.match_main(text, text1[:self.Match_MaxBits],
+                                  expected_loc)
+      if start_loc != -1:
+        end_loc = self.match_main(text, text1[-self.Match_MaxBits:],
+            expected_loc + len(text1) - self.Match_MaxBits)
+        if end_loc == -1 or start_loc >= end_loc:
+          # Can't find valid trailing context.  Drop this patch.
+          start_loc = -1
+    else:
+      start_loc = self.match_main(text, text1, expected_loc)
+    if start_loc == -1:
+      # No match found.  :(
+      results.append(False)
+      # Subtract the delta for this failed patch from subsequent patches.
+      delta -= patch.length2 - patch.length1
+      return (text, delta)
+
+    # Found a match.  :)
+    results.append(True)
+    delta = start_loc - expected_loc
+    if end_loc == -1:
+      text2 = text[start_loc : start_loc + len(text1)]
+    else:
+      text2 = text[start_loc : end_loc + self.Match_MaxBits]
+    if text1 == text2:
+      # Perfect match, just shove the replacement text in.
+      text = (text[:start_loc] + self.diff_text2(patch.diffs) +
+                  text[start_loc + len(text1):])
+    else:
+      # Imperfect match.
+      # Run a diff to get a framework of equivalent indices.
+      diffs = self.diff_main(text1, text2, False)
+      if (len(text1) > self.Match_MaxBits and
+          self.diff_levenshtein(diffs) / float(len(text1)) >
+          self.Patch_DeleteThreshold):
+        # The end points match, but the content is unacceptably bad.
+        results[-1] = False
+      else:
+        self.diff_cleanupSemanticLossless(diffs)
+        index1 = 0
+        for (op, data) in patch.diffs:
+          if op != self.DIFF_EQUAL:
+            index2 = self.diff_xIndex(diffs, index1)
+          if op == self.DIFF_INSERT:  # Insertion
+            text = text[:start_loc + index2] + data + text[start_loc +
+                                                           index2:]
+          elif op == self.DIFF_DELETE:  # Deletion
+            text = text[:start_loc + index2] + text[start_loc +
+                self.diff_xIndex(diffs, index1 + len(data)):]
+          if op != self.DIFF_DELETE:
+            index1 += len(data)
+    return (text, delta)
+
+  def patch_nullPadding(self):
+    """The padding string added on each side of the text by patch_apply."""
+    nullPadding = ""
+    for x in range(1, self.Patch_Margin + 1):
+      nullPadding += chr(x)
+    return nullPadding
+
   def patch_addPadding(self, patches):
     """Add some padding on text start and end so that edges can match
     something.  Intended to be called only from within patch_apply.
@@ -1335,53 +1423,60 @@ class diff_match_patch:
     Returns:
       The padding string added to each side.
     """
-    paddingLength = self.Patch_Margin
-    nullPadding = ""
-    for x in range(1, paddingLength + 1):
-      nullPadding += chr(x)
+    nullPadding = self.patch_nullPadding()
+    for x in range(len(patches)):
+      self.patch_padPatch(patches[x], nullPadding, x == 0,
+                          x == len(patches) - 1)
+    return nullPadding
 
-    # Bump all the patches forward.
-    for patch in patches:
-      patch.start1 += paddingLength
-      patch.start2 += paddingLength
+  def patch_padPatch(self, patch, nullPadding, first, last):
+    """Bump one patch forward by the padding, and pad its start if it is the
+    first patch and its end if it is the last one.
 
-    # Add some padding on start of first diff.
-    patch = patches[0]
-    diffs = patch.diffs
-    if not diffs or diffs[0][0] != self.DIFF_EQUAL:
-      # Add nullPadding equality.
-      diffs.insert(0, (self.DIFF_EQUAL, nullPadding))
-      patch.start1 -= paddingLength  # Should be 0.
-      patch.start2 -= paddingLength  # Should be 0.
-      patch.length1 += paddingLength
-      patch.length2 += paddingLength
-    elif paddingLength > len(diffs[0][1]):
-      # Grow first equality.
-      extraLength = paddingLength - len(diffs[0][1])
-      newText = nullPadding[len(diffs[0][1]):] + diffs[0][1]
-      diffs[0] = (diffs[0][0], newText)
-      patch.start1 -= extraLength
-      patch.start2 -= extraLength
-      patch.length1 += extraLength
-      patch.length2 += extraLength
-
-    # Add some padding on end of last diff.
-    patch = patches[-1]
-    diffs = patch.diffs
-    if not diffs or diffs[-1][0] != self.DIFF_EQUAL:
-      # Add nullPadding equality.
-      diffs.append((self.DIFF_EQUAL, nullPadding))
-      patch.length1 += paddingLength
-      patch.length2 += paddingLength
-    elif paddingLength > len(diffs[-1][1]):
-      # Grow last equality.
-      extraLength = paddingLength - len(diffs[-1][1])
-      newText = diffs[-1][1] + nullPadding[:extraLength]
-      diffs[-1] = (diffs[-1][0], newText)
-      patch.length1 += extraLength
-      patch.length2 += extraLength
+    Args:
+      patch: Patch object.
+      nullPadding: The padding string added to each side.
+      first: True for the first patch.
+      last: True for the last patch.
+    """
+    paddingLength = len(nullPadding)
+    patch.start1 += paddingLength
+    patch.start2 += paddingLength
 
-    return nullPadding
+    diffs = patch.diffs
+    if first:
+      # Add some padding on start of first diff.
+      if not diffs or diffs[0][0] != self.DIFF_EQUAL:
+        # Add nullPadding equality.
+        diffs.insert(0, (self.DIFF_EQUAL, nullPadding))
+        patch.start1 -= paddingLength  # Should be 0.
+        patch.start2 -= paddingLength  # Should be 0.
+        patch.length1 += paddingLength
+        patch.length2 += paddingLength
+      elif paddingLength > len(diffs[0][1]):
+        # Grow first equality.
+        extraLength = paddingLength - len(diffs[0][1])
+        newText = nullPadding[len(diffs[0][1]):] + diffs[0][1]
+        diffs[0] = (diffs[0][0], newText)
+        patch.start1 -= extraLength
+        patch.start2 -= extraLength
+        patch.length1 += extraLength
+        patch.length2 += extraLength
+
+    if last:
+      # Add some padding on end of last diff.
+      if not diffs or diffs[-1][0] != self.DIFF_EQUAL:
+        # Add nullPadding equality.
+        diffs.append((self.DIFF_EQUAL, nullPadding))
+        patch.length1 += paddingLength
+        patch.length2 += paddingLength
+      elif paddingLength > len(diffs[-1][1]):
+        # Grow last equality.
+        extraLength = paddingLength - len(diffs[-1][1])
+        newText = diffs[-1][1] + nullPadding[:extraLength]
+        diffs[-1] = (diffs[-1][0], newText)
+        patch.length1 += extraLength
+        patch.length2 += extraLength
 
   def patch_splitMax(self, patches):
     """Look through the patches and break up any which are longer than the
@@ -1477,10 +1572,16 @@ class diff_match_patch:
       # fastpath
       if len(res) == 1:
           return s
+      hextochr = diff_match_patch._hextochr
+      if hextochr is None:
+          hexdig = diff_match_patch._hexdig
+          hextochr = dict((a+b, chr(int(a+b,16)))
+                          for a in hexdig for b in hexdig)
+          diff_match_patch._hextochr = hextochr
       s = res[0]
       for item in res[1:]:
           try:
-              s += self._hextochr[item[:2]] + item[2:]
+              s += hextochr[item[:2]] + item[2:]
           except KeyError:
               s += '%' + item
 #          except UnicodeDecodeError:
@@ -1564,11 +1665,163 @@ class diff_match_patch:
         del text[0]
     return patches
 
+  def patch_coords(self, start, length):
+    """Convert the 1-based coordinates of a patch header to 0-based ones.
+
+    Args:
+      start: Start as written in the header.
+      length: Length as written in the header, may be empty.
+
+    Returns:
+      Tuple of start and length.
+    """
+    if length == '':
+      return (int(start) - 1, 1)
+    elif length == '0':
+      return (int(start), 0)
+    return (int(start) - 1, int(length))
+
+  def patch_fromTextCompact(self, textline):
+    """Parse a textual representation of patches into a patch_list.
+    Same format as patch_fromText, without one object per diff.
+
+    Args:
+      textline: Text representation of patches.
+
+    Returns:
+      patch_list.
+
+    Raises:
+      ValueError: If invalid input.
+    """
+    if type(textline) == bytes:
+      textline = textline.decode("ascii")
+    # Upper bounds, every header holds '@@ -' and every diff is one line
+    patches = patch_list(textline.count('\n') + 1, textline.count('@@ -'))
+    parts = []
+    size = 0
+    pos = 0
+    end = len(textline)
+    while pos < end:
+      eol = textline.find('\n', pos)
+      if eol < 0:
+        eol = end
+      line = textline[pos:eol]
+      pos = eol + 1
+      if not line:
+        # Blank line?  Whatever.
+        continue
+
+      sign = line[0]
+      if sign == '@':
+        m = ure.match("^@@ -(\d+),?(\d*) \+(\d+),?(\d*) @@$", line)
+        if not m:
+          raise ValueError("Invalid patch string: " + line)
+        (start1, length1) = self.patch_coords(m.group(1), m.group(2))
+        (start2, length2) = self.patch_coords(m.group(3), m.group(4))
+        patches.add_patch(start1, start2, length1, length2)
+        continue
+
+      if sign == '+':
+        op = self.DIFF_INSERT
+      elif sign == '-':
+        op = self.DIFF_DELETE
+      elif sign == ' ':
+        op = self.DIFF_EQUAL
+      else:
+        raise ValueError("Invalid patch mode: '%s'\n%s" % (sign, line))
+      if not len(patches):
+        raise ValueError("Invalid patch string: " + line)
+      data = self.unquote(line[1:])
+      patches.add_diff(op, size, len(data))
+      parts.append(data)
+      size += len(data)
+
+    patches.text = ''.join(parts)
+    return patches
+
+
+class patch_list:
+  """Patches parsed by patch_fromTextCompact.
+
+  The diffs of all the patches are kept in preallocated parallel arrays of
+  operation, offset and length into a single text buffer.  A patch_obj is
+  only built when a patch is needed.
+  """
+
+  __slots__ = ('count', 'diff_count', 'start1', 'start2', 'length1',
+               'length2', 'first', 'ops', 'offsets', 'lengths', 'text')
+
+  def __init__(self, max_diffs, max_patches):
+    """Preallocates room for max_diffs diffs in max_patches patches.
+    """
+    self.count = 0
+    self.diff_count = 0
+    self.start1 = array.array('i', [0] * max_patches)
+    self.start2 = array.array('i', [0] * max_patches)
+    self.length1 = array.array('i', [0] * max_patches)
+    self.length2 = array.array('i', [0] * max_patches)
+    # Index of the first diff of each patch
+    self.first = array.array('i', [0] * max_patches)
+    self.ops = array.array('b', [0] * max_diffs)
+    self.offsets = array.array('i', [0] * max_diffs)
+    self.lengths = array.array('i', [0] * max_diffs)
+    self.text = ''
+
+  def __len__(self):
+    return self.count
+
+  def add_patch(self, start1, start2, length1, length2):
+    i = self.count
+    self.start1[i] = start1
+    self.start2[i] = start2
+    self.length1[i] = length1
+    self.length2[i] = length2
+    self.first[i] = self.diff_count
+    self.count += 1
+
+  def add_diff(self, op, offset, length):
+    i = self.diff_count
+    self.ops[i] = op
+    self.offsets[i] = offset
+    self.lengths[i] = length
+    self.diff_count += 1
+
+  def patch(self, i):
+    """Build the patch_obj of patch i.
+
+    Args:
+      i: Index of the patch.
+
+    Returns:
+      patch_obj.
+    """
+    patch = patch_obj()
+    patch.start1 = self.start1[i]
+    patch.start2 = self.start2[i]
+    patch.length1 = self.length1[i]
+    patch.length2 = self.length2[i]
+    end = self.first[i + 1] if i + 1 < self.count else self.diff_count
+    for d in range(self.first[i], end):
+      offset = self.offsets[d]
+      patch.diffs.append((self.ops[d], self.text[offset:offset + self.lengths[d]]))
+    return patch
+
+  def patches(self):
+    """Build the patch_obj of every patch.
+
+    Returns:
+      Array of Patch objects.
+    """
+    return [self.patch(i) for i in range(self.count)]
+
 
 class patch_obj:
   """Class representing one patch operation.
   """
 
+  __slots__ = ('diffs', 'start1', 'start2', 'length1', 'length2')
+
   def __init__(self):
     """Initializes with an empty list of diffs.
     """
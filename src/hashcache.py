@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Cache of file hashes keyed by path, size and modification time.
+#
+# Hashing every file of /flash is slow, so the SHA1 of a file is only
+# computed again when uos.stat() reports another size or mtime than when it
+# was cached. Files written by an update are added with the hash computed
+# while writing them. FatFS keeps a 2 s mtime and the RTC may not be set,
+# so a file rewritten by hand with the same size in the same second is not
+# noticed; updates always go through put().
+#
+# The cache is one binary file, loaded into a dict:
+#
+#   b'HC' + version (B) + count (H)
+#   count times: path length (B), path, size (I), mtime (I), sha1 (20s)
+#   crc32 (I) of everything before it
+#
+# A damaged file is ignored, the hashes are then simply computed again.
+
+import ubinascii
+import ustruct
+import uos
+import inventory
+
+CACHE_FILE = '/flash/hash_cache'
+
+MAGIC = b'HC'
+VERSION = 1
+HEADER = '<2sBH'
+RECORD = '<II20s'
+CRC = '<I'
+
+
+class HashCache:
+
+    def __init__(self, path = None):
+        self.path = path if path is not None else CACHE_FILE
+        # path -> (size, mtime, sha1)
+        self.entries = dict()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        self.entries = dict()
+        try:
+            with open(self.path, 'rb') as fh:
+                data = fh.read()
+        except OSError:
+            return
+
+        try:
+            body = memoryview(data)[:-4]
+            if ustruct.unpack_from(CRC, data, len(data) - 4)[0] != ubinascii.crc32(body) & 0xffffffff:
+                print("Hash cache is damaged, ignoring it")
+                return
+
+            magic, version, count = ustruct.unpack_from(HEADER, data, 0)
+            if magic != MAGIC or version != VERSION:
+                return
+
+            pos = ustruct.calcsize(HEADER)
+            record = ustruct.calcsize(RECORD)
+            for _ in range(count):
+                length = data[pos]
+                path = bytes(body[pos + 1:pos + 1 + length]).decode()
+                pos += 1 + length
+                self.entries[path] = ustruct.unpack_from(RECORD, data, pos)
+                pos += record
+        except Exception as ex:
+            print("Error loading hash cache: {}".format(ex))
+            self.entries = dict()
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        out = bytearray(ustruct.pack(HEADER, MAGIC, VERSION, len(self.entries)))
+        for path, entry in self.entries.items():
+            name = path.encode()
+            out.append(len(name))
+            out.extend(name)
+            out.extend(ustruct.pack(RECORD, entry[0], entry[1], entry[2]))
+        out.extend(ustruct.pack(CRC, ubinascii.crc32(out) & 0xffffffff))
+
+        try:
+            with open(self.path, 'wb') as fh:
+                fh.write(out)
+            self.dirty = False
+        except Exception as ex:
+            print("Error saving hash cache: {}".format(ex))
+
+    def _stat(self, path):
+        st = uos.stat(path)
+        return (st[6], st[8])
+
+    def lookup(self, path):
+        # Cached SHA1 of path, or None if it is unknown or the file changed
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        try:
+            if self._stat(path) != (entry[0], entry[1]):
+                return None
+        except OSError:
+            return None
+        return entry[2]
+
+    def get(self, path):
+        # SHA1 of path, only hashed when not cached or changed
+        digest = self.lookup(path)
+        if digest is not None:
+            self.hits += 1
+            return digest
+
+        self.misses += 1
+        size, mtime = self._stat(path)
+        digest = inventory.file_hash(path)
+        self.entries[path] = (size, mtime, digest)
+        self.dirty = True
+        return digest
+
+    def put(self, path, digest):
+        # Records the hash of a file that was just written
+        size, mtime = self._stat(path)
+        self.entries[path] = (size, mtime, digest)
+        self.dirty = True
+
+    def drop(self, prefix):
+        # Forgets every file below prefix, e.g. a slot that is rebuilt
+        for path in [path for path in self.entries if path.startswith(prefix)]:
+            del self.entries[path]
+            self.dirty = True
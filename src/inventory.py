@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# Content addressed inventory of an application slot.
+#
+# Every file of a slot is identified by the SHA1 of its content. The hashes
+# of the A/B slots are stored next to their index, one line per file, with
+# the number of entries on the last line:
+#
+#   <hex sha1> <path>
+#   #<count>
+#
+# They are written when a slot is built, from the hashes the update already
+# computed, so only the files touched by an update are ever rehashed.
+#
+# The device reports the Merkle root of its inventory. Leaves are
+# sha1(path + b'\0' + file hash) sorted by path, and every parent is the
+# sha1 of its two children (an odd node is carried up unchanged). The server
+# asks for the children of the nodes that differ from what it expects and
+# so finds the files that actually differ in a few round trips.
+
+import ubinascii
+import uhashlib
+import slots
+import uos
+
+HASH_CHUNK = 512
+
+# Bytes of a hash sent in an uplink
+TRUNCATED = 8
+
+
+def inventory_path(slot):
+    return '{}/inventory_{}'.format(slots.FLASH_ROOT, slot)
+
+
+def file_hash(path):
+    h = uhashlib.sha1()
+    buf = bytearray(HASH_CHUNK)
+    mv = memoryview(buf)
+    with open(path, 'rb') as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+    return h.digest()
+
+
+def read(slot):
+    # Returns path -> hash of the slot, or None if it is unknown. Files can
+    # be uploaded to the /flash root by hand, so its hashes are never stored.
+    if slot == slots.ROOT_SLOT:
+        return None
+
+    try:
+        with open(inventory_path(slot), 'r') as fh:
+            lines = fh.read().split('\n')
+    except OSError:
+        return None
+
+    # The last line holds the number of entries, a truncated file is unusable
+    try:
+        if int(lines[-1][1:]) != len(lines) - 1:
+            return None
+    except ValueError:
+        return None
+
+    hashes = dict()
+    for line in lines[:-1]:
+        hashes[line[41:]] = ubinascii.unhexlify(line[:40])
+    return hashes
+
+
+def write(slot, hashes):
+    with open(inventory_path(slot), 'w') as fh:
+        for path, digest in hashes.items():
+            fh.write('{} {}\n'.format(ubinascii.hexlify(digest).decode(), path))
+        fh.write('#{}'.format(len(hashes)))
+
+
+def remove(slot):
+    try:
+        uos.remove(inventory_path(slot))
+    except OSError:
+        pass  # There is no inventory
+
+
+def hex_hash(digest):
+    # Truncated hash as sent in an uplink
+    return ubinascii.hexlify(digest[:TRUNCATED]).decode()
+
+
+def merkle_levels(hashes):
+    # Returns the levels of the Merkle tree, leaves first and root last
+    paths = sorted(hashes)
+    level = []
+    for path in paths:
+        h = uhashlib.sha1(path.encode() + b'\0')
+        h.update(hashes[path])
+        level.append(h.digest())
+    if not level:
+        level.append(uhashlib.sha1().digest())
+
+    levels = [level]
+    while len(level) > 1:
+        parents = []
+        for idx in range(0, len(level) - 1, 2):
+            h = uhashlib.sha1(level[idx])
+            h.update(level[idx + 1])
+            parents.append(h.digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+        levels.append(level)
+    return levels, paths
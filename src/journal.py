@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+# Write-ahead journal for building an update slot.
+#
+# Records are appended one per line and carry their own CRC so that a torn
+# last line is detected and ignored:
+#
+#   B,<slot>          build of <slot> started
+#   F,<path>,<crc>    <path> written to the slot with content CRC <crc>
+#   C                 every file is written, the slot may be activated
+#
+# recover() is called at boot. A journal without a commit record is rolled
+# back (the half built slot is simply never activated). A committed journal
+# is rolled forward once the CRC of every journaled file has been checked.
+# Only the files named in the journal are touched, no directory is scanned.
+
+import ubinascii
+import slots
+import uos
+
+JOURNAL_FILE = '/flash/ota_journal'
+
+BEGIN = 'B'
+FILE = 'F'
+COMMIT = 'C'
+
+CRC_CHUNK = 512
+
+
+def crc32(data, crc=0):
+    return ubinascii.crc32(data, crc) & 0xffffffff
+
+
+def file_crc(path):
+    crc = 0
+    buf = bytearray(CRC_CHUNK)
+    mv = memoryview(buf)
+    with open(path, 'rb') as fh:
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            crc = crc32(mv[:n], crc)
+    return crc
+
+
+def _append(fields, mode='a'):
+    body = ','.join(fields)
+    with open(JOURNAL_FILE, mode) as fh:
+        fh.write('{},{}\n'.format(body, crc32(body.encode())))
+
+
+def begin(slot):
+    _append((BEGIN, slot), 'w')
+
+
+def record_file(path, crc):
+    _append((FILE, path, str(crc)))
+
+
+def commit():
+    _append((COMMIT,))
+
+
+def clear():
+    try:
+        uos.remove(JOURNAL_FILE)
+    except OSError:
+        pass  # There is no journal
+
+
+def read():
+    # Returns (slot, files, committed) or None if there is no usable journal
+    try:
+        with open(JOURNAL_FILE, 'r') as fh:
+            lines = fh.read().split('\n')
+    except OSError:
+        return None
+
+    slot = None
+    files = []
+    committed = False
+    for line in lines:
+        if not line:
+            continue
+        idx = line.rfind(',')
+        body = line[:idx]
+        try:
+            if idx < 0 or int(line[idx + 1:]) != crc32(body.encode()):
+                break
+        except ValueError:
+            break
+
+        fields = body.split(',')
+        if fields[0] == BEGIN:
+            slot = fields[1]
+        elif fields[0] == FILE:
+            files.append((fields[1], int(fields[2])))
+        elif fields[0] == COMMIT:
+            committed = True
+            break
+
+    if slot is None:
+        return None
+    return (slot, files, committed)
+
+
+def recover():
+    entry = read()
+    if entry is None:
+        clear()
+        return
+
+    slot, files, committed = entry
+    if not committed:
+        print("Journal: update of slot {} was interrupted, rolling back".format(slot))
+    elif slots.active_slot() != slot:
+        root = slots.slot_path(slot)
+        for path, crc in files:
+            try:
+                valid = file_crc(root + '/' + path) == crc
+            except OSError:
+                valid = False
+            if not valid:
+                print("Journal: {} is corrupted, rolling back".format(path))
+                break
+        else:
+            print("Journal: activating slot {}".format(slot))
+            slots.activate(slot)
+
+    clear()
@@ -1,46 +1,188 @@
 #!/usr/bin/env python
 
 from network import LoRa
-import socket
+import usocket as socket
 import binascii
 import struct
-import time
+import utime as time
 import _thread
+import airtime
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+
+class Wakeup:
+
+    # Wakes a task waiting in the event loop, also from the radio callback.
+    # uasyncio has ThreadSafeFlag for this; CPython asyncio, which runs the
+    # host tests, only has an Event, which is enough there because the
+    # callback is called from the event loop.
+
+    def __init__(self):
+        if hasattr(asyncio, 'ThreadSafeFlag'):
+            self._flag = asyncio.ThreadSafeFlag()
+        else:
+            self._flag = asyncio.Event()
+
+    def set(self):
+        self._flag.set()
+
+    def clear(self):
+        # Called before checking for work, a set() after it is not lost
+        if hasattr(self._flag, 'clear'):
+            self._flag.clear()
+
+    async def wait(self, timeout_ms):
+        # Returns when set, or after timeout_ms at the latest
+        try:
+            await asyncio.wait_for(self._flag.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+
+
+class Frames:
+
+    # Async iterator over the frames queued by the radio callback, which
+    # wakes it. on_idle is called every idle_ms while there is none.
+
+    def __init__(self, queue, lock, wakeup, idle_ms, on_idle = None):
+        self._queue = queue
+        self._lock = lock
+        self._wakeup = wakeup
+        self._idle_ms = idle_ms
+        self._on_idle = on_idle
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                if self._queue:
+                    return self._queue.pop(0)
+            if self._on_idle is not None:
+                self._on_idle()
+            await self._wakeup.wait(self._idle_ms)
+
 
 class LoraNet:
-    def __init__(self, frequency, dr, region, device_class=LoRa.CLASS_C, activation = LoRa.OTAA, auth = None):
+
+    # Uplink priorities, lower values are sent first
+    PRIO_OTA = 0
+    PRIO_NACK = 1
+    PRIO_TELEMETRY = 2
+
+    SEND_POLL_MS = 100
+    # Longest wait without work, the tasks still beat their heartbeat
+    IDLE_WAIT_MS = 5000
+    # Time given to the stack between the join and the first uplink
+    JOIN_SETTLE_S = 2
+
+    # Telemetry batches kept while the uplinks are held back, about an hour
+    # of batches; the oldest one is dropped beyond that
+    MAX_TELEMETRY_QUEUE = 12
+
+    # Link margin in dB kept when picking the DR for OTA uplinks
+    LINK_MARGIN = 10
+    MAX_DR = 5
+
+    # A join attempt waits JOIN_BACKOFF_MIN_MS for the accept, doubling up to
+    # JOIN_BACKOFF_MAX_MS, and steps the DR down on every failed attempt
+    JOIN_BACKOFF_MIN_MS = 8000
+    JOIN_BACKOFF_MAX_MS = 600000
+    JOIN_REQUEST_SIZE = 23
+
+    # Class A receive windows close about 2 s after an uplink
+    RX_WINDOW_MS = 3000
+
+    # Heartbeat budget of run() for the hardware watchdog
+    HEARTBEAT = 'radio'
+    MAX_STALL_MS = 60000
+
+    def __init__(self, frequency, dr, region, device_class=LoRa.CLASS_A, activation = LoRa.OTAA, auth = None, hwdt = None):
         self.frequency = frequency
         self.dr = dr
         self.region = region
         self.device_class = device_class
         self.activation = activation
         self.auth = auth
+        self.hwdt = hwdt
         self.sock = None
         self._exit = False
-        self.s_lock = _thread.allocate_lock()
         self.lora = LoRa(mode=LoRa.LORAWAN, region = self.region, device_class = self.device_class)
 
+        # Filled by the radio callback, which runs outside of the event loop
         self._msg_queue = []
+        self._ota_frames = []
         self.q_lock = _thread.allocate_lock()
-        self._process_ota_msg = None
+        self._frame_wakeup = Wakeup()
+
+        # Pending uplinks per priority as [packet, dr, done], drained by run()
+        self._send_queues = ([], [], [])
+        self._send_wakeup = Wakeup()
+        # Sub-band -> (ticks_ms of the last uplink, ms it must stay silent)
+        self._band_busy = dict()
+        # Sub-band -> total airtime used in ms
+        self.airtime_used = dict()
+        # Frames handed to the radio since boot
+        self.uplinks = 0
+
+        # Smoothed link quality of received downlinks, None until one arrives
+        self.rssi = None
+        self.snr = None
+        self._sock_dr = dr
+
+        self._join_dr = dr
+        self._join_started = None
+        self._join_backoff = self.JOIN_BACKOFF_MIN_MS
+        self._last_uplink = None
 
     def stop(self):
         self._exit = True
+        self._send_wakeup.set()
+
+    def update_link_stats(self):
+        stats = self.lora.stats()
+        if self.snr is None:
+            self.rssi = stats.rssi
+            self.snr = stats.snr
+        else:
+            self.rssi += (stats.rssi - self.rssi) / 4
+            self.snr += (stats.snr - self.snr) / 4
+
+    def fast_dr(self):
+        # Fastest DR the last downlinks show to be viable
+        if self.snr is None:
+            return self.dr
+        return airtime.fastest_dr(self.snr, self.LINK_MARGIN, self.MAX_DR)
 
-    def init(self, process_msg_callback):
-        self._process_ota_msg = process_msg_callback
+    def set_dr(self, dr):
+        # Changes the DR of the uplinks that do not pick their own
+        self.dr = dr
 
     def receive_callback(self, lora):
         events = lora.events()
         if events & LoRa.RX_PACKET_EVENT:
+            if self.sock is None:
+                return
             rx, port = self.sock.recvfrom(256)
             if rx:
-                if '$OTA' in rx:
-                    self._process_ota_msg(rx)
-                else:
-                    self.q_lock.acquire()
-                    self._msg_queue.append(rx)
-                    self.q_lock.release()
+                self.update_link_stats()
+                # Frames are only queued here, they are handled in the event loop
+                with self.q_lock:
+                    if b'$OTA' in rx:
+                        self._ota_frames.append(rx)
+                    else:
+                        self._msg_queue.append(rx)
+                self._frame_wakeup.set()
+
+    def frames(self, on_idle = None):
+        # async for frame in lora.frames() yields the received OTA frames
+        return Frames(self._ota_frames, self.q_lock, self._frame_wakeup, self.IDLE_WAIT_MS, on_idle)
 
     def connect(self):
         if self.activation != LoRa.OTAA:
@@ -48,6 +190,16 @@ class LoraNet:
         if len(self.auth) < 3:
             raise ValueError("Invalid authentication parameters")
 
+        self._configure()
+
+        # create an OTAA authentication params
+        self.dev_eui = binascii.unhexlify(self.auth[0])
+        self.app_eui = binascii.unhexlify(self.auth[1])
+        self.app_key = binascii.unhexlify(self.auth[2])
+
+        # The join runs in run(), uplinks are queued until it is done
+
+    def _configure(self):
         self.lora.callback(trigger=LoRa.RX_PACKET_EVENT, handler=self.receive_callback)
 
         # set the 3 default channels to the same frequency
@@ -59,26 +211,90 @@ class LoraNet:
         for i in range(3, 16):
             self.lora.remove_channel(i)
 
-        # authenticate with otaa
-        self._authenticate_otaa(self.auth)
+    def set_class_c(self, enabled):
+        # Class C keeps the receiver on, it is only needed while an update runs
+        device_class = LoRa.CLASS_C if enabled else LoRa.CLASS_A
+        if device_class == self.device_class:
+            return
+
+        print('Switching to class {}'.format('C' if enabled else 'A'))
+        joined = self.sock is not None
+        if joined:
+            self.lora.nvram_save()
+        self.lora.init(mode=LoRa.LORAWAN, region=self.region, device_class=device_class)
+        self.device_class = device_class
+        if joined:
+            self.lora.nvram_restore()
+        self._configure()
 
-        # create socket to server
-        self._create_socket()
+    def radio_idle(self):
+        # True when nothing is queued and the receive windows of the last
+        # uplink are over, so the CPU may sleep without missing a downlink
+        if self.sock is None or self.device_class == LoRa.CLASS_C or self.pending():
+            return False
+        if self._last_uplink is None:
+            return True
+        return time.ticks_diff(time.ticks_ms(), self._last_uplink) > self.RX_WINDOW_MS
 
-    def _authenticate_otaa(self, auth_params):
+    def joined(self):
+        return self.sock is not None
 
-        # create an OTAA authentication params
-        self.dev_eui = binascii.unhexlify(auth_params[0])
-        self.app_eui = binascii.unhexlify(auth_params[1])
-        self.app_key = binascii.unhexlify(auth_params[2])
+    def save_session(self):
+        if self.sock is None:
+            return
+        try:
+            self.lora.nvram_save()
+        except Exception as ex:
+            print("Error saving LoRaWAN session: {}".format(ex))
+
+    def _restore_session(self):
+        try:
+            self.lora.nvram_restore()
+            if self.lora.has_joined():
+                return True
+        except Exception as ex:
+            print("Error restoring LoRaWAN session: {}".format(ex))
+
+        # Do not retry a broken session on the next boot, fall back to a join
+        try:
+            self.lora.nvram_erase()
+        except Exception:
+            pass  # Nothing stored
+        return False
+
+    def _authenticate_otaa(self):
+        self.lora.join(activation=LoRa.OTAA, auth=(self.dev_eui, self.app_eui, self.app_key), timeout=0, dr=self._join_dr)
+        self._join_started = time.ticks_ms()
+
+        band = airtime.sub_band(self.frequency)
+        sf, bw = airtime.EU868_DATA_RATES[self._join_dr]
+        toa = airtime.time_on_air(self.JOIN_REQUEST_SIZE, sf, bw)
+        self._band_busy[band] = (self._join_started, int(toa + airtime.off_time(toa, self.frequency)))
+
+    def _join_step(self):
+        # One step of the join state machine, returns True once joined
+        if self._join_started is None:
+            if self._restore_session():
+                print('Restored LoRaWAN session')
+                self._create_socket()
+                return True
+            self._authenticate_otaa()
+            return False
 
-        self.lora.join(activation=LoRa.OTAA, auth=(self.dev_eui, self.app_eui, self.app_key), timeout=0, dr=self.dr)
+        if self.lora.has_joined():
+            print('Joined LoRaWAN network')
+            self.lora.nvram_save()
+            self._create_socket()
+            return True
 
-        while not self.lora.has_joined():
-            time.sleep(2.5)
-            print('Not joined yet...')
+        if time.ticks_diff(time.ticks_ms(), self._join_started) < self._join_backoff:
+            return False
 
-        print('Joined LoRaWAN network')
+        self._join_backoff = min(self._join_backoff * 2, self.JOIN_BACKOFF_MAX_MS)
+        self._join_dr = max(self._join_dr - 1, 0)
+        print('Not joined yet, retrying at DR{}'.format(self._join_dr))
+        self._authenticate_otaa()
+        return False
 
     def _create_socket(self):
 
@@ -91,11 +307,110 @@ class LoraNet:
         # make the socket non blocking
         self.sock.setblocking(False)
 
-        time.sleep(2)
+    def queue(self, packet, priority = PRIO_TELEMETRY):
+        # Queues the packet and returns immediately, run() sends it
+        queue = self._send_queues[priority]
+        if priority == self.PRIO_TELEMETRY and len(queue) >= self.MAX_TELEMETRY_QUEUE:
+            # Every batch holds its own samples, they are only dropped when
+            # the network has been out of reach for a long time
+            queue.pop(0)[2] = True
+        # OTA uplinks go out at the fastest viable DR to save airtime
+        dr = self.dr if priority == self.PRIO_TELEMETRY else self.fast_dr()
+        entry = [packet, dr, False]
+        queue.append(entry)
+        self._send_wakeup.set()
+        return entry
+
+    async def send(self, packet, priority = PRIO_TELEMETRY):
+        # Returns once the packet was sent, or dropped from a full telemetry queue
+        entry = self.queue(packet, priority)
+        while not entry[2]:
+            await asyncio.sleep(self.SEND_POLL_MS / 1000)
+
+    def max_payload(self):
+        return airtime.max_payload(self.dr)
+
+    def pending(self):
+        return sum(len(queue) for queue in self._send_queues)
+
+    def _next_packet(self):
+        for queue in self._send_queues:
+            if queue:
+                return queue.pop(0)
+        return None
+
+    def _band_wait(self, band):
+        # ms until the sub-band duty cycle allows another uplink
+        busy = self._band_busy.get(band)
+        if busy is None:
+            return 0
+        return max(busy[1] - time.ticks_diff(time.ticks_ms(), busy[0]), 0)
+
+    def _transmit(self, packet, dr):
+        band = airtime.sub_band(self.frequency)
+        toa = airtime.uplink_time_on_air(len(packet), dr)
+
+        if dr != self._sock_dr:
+            self.sock.setsockopt(socket.SOL_LORA, socket.SO_DR, dr)
+            self._sock_dr = dr
+        sent_at = time.ticks_ms()
+        self.sock.send(packet)
+        self._last_uplink = sent_at
+        self.uplinks += 1
+        # Keep the frame counters so a reboot can skip the join
+        self.lora.nvram_save()
+
+        self._band_busy[band] = (sent_at, int(toa + airtime.off_time(toa, self.frequency)))
+        self.airtime_used[band] = self.airtime_used.get(band, 0) + toa
+
+    def heartbeat(self):
+        if self.hwdt is not None:
+            self.hwdt.beat(self.HEARTBEAT)
+
+    async def run(self):
+        # Joins the network and then sends the queued uplinks. Every pass
+        # beats, so the hardware watchdog is no longer fed once it has died.
+        if self.hwdt is not None:
+            self.hwdt.register(self.HEARTBEAT, self.MAX_STALL_MS)
+
+        poll = self.SEND_POLL_MS / 1000
+        while self.sock is None and not self._exit:
+            self.heartbeat()
+            try:
+                joined = self._join_step()
+            except Exception as ex:
+                print("Error joining: {}".format(ex))
+                await asyncio.sleep(self.JOIN_BACKOFF_MIN_MS / 1000)
+                continue
+            if joined:
+                # Give the stack some time before the first uplink
+                await asyncio.sleep(self.JOIN_SETTLE_S)
+            else:
+                await asyncio.sleep(poll)
+
+        band = airtime.sub_band(self.frequency)
+        while not self._exit:
+            self.heartbeat()
+            wait = self._band_wait(band)
+            if wait > 0:
+                await asyncio.sleep(min(wait, self.IDLE_WAIT_MS) / 1000)
+                continue
+
+            # queue() wakes the loop, no polling while there is nothing to send
+            self._send_wakeup.clear()
+            entry = self._next_packet()
+            if entry is None:
+                await self._send_wakeup.wait(self.IDLE_WAIT_MS)
+                continue
+
+            try:
+                self._transmit(entry[0], entry[1])
+            except Exception as ex:
+                print("Error sending packet: {}".format(ex))
+            entry[2] = True
 
-    def send(self, packet):
-        with self.s_lock:
-            self.sock.send(packet)
+        if self.hwdt is not None:
+            self.hwdt.unregister(self.HEARTBEAT)
 
     def receive(self, bufsize):
         with self.q_lock:
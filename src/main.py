@@ -2,20 +2,45 @@
 
 from loranet import LoraNet
 from ota import LoraOTA
+from watchdog import HardwareWatchdog
+from telemetry import TelemetryBuffer
 from network import LoRa
+import uasyncio as asyncio
+import machine
 import utime
 from utils import random_range
+from utils import eui_jitter
 import uos
 from new_file_test import printiton
 import os
 import pycom
+import slots
 
 LORA_FREQUENCY = 868100000
 LORA_NODE_DR = 5
+# DR the server sends the multicast update fragments at
+LORA_MULTICAST_DR = 5
 LORA_REGION = LoRa.EU868
-LORA_DEVICE_CLASS = LoRa.CLASS_C
+# Class C is only enabled by LoraOTA while an update is in progress
+LORA_DEVICE_CLASS = LoRa.CLASS_A
 LORA_ACTIVATION = LoRa.OTAA
-VERSION_FILE = '/flash/version.py'
+# Slot this firmware runs from, the pointer changes once an update is activated
+RUNNING_SLOT = slots.active_slot()
+VERSION_FILE = slots.slot_path(RUNNING_SLOT) + '/version.py'
+# The main loop must beat at least every MAIN_MAX_STALL_MS, otherwise the
+# hardware watchdog resets the device after HW_WDT_TIMEOUT_MS
+HW_WDT_TIMEOUT_MS = 30000
+MAIN_MAX_STALL_MS = 20000
+# Sensors are sampled every TELEMETRY_SAMPLE_S and sent in a batch every
+# TELEMETRY_BATCH_S, or earlier when a batch fills the payload of the DR
+TELEMETRY_SAMPLE_S = 5
+TELEMETRY_BATCH_S = 300
+# Post-update reboots and the first version report are spread per DevEUI
+# over these windows so a multicast group does not uplink all at once
+REBOOT_JITTER_S = 60
+REPORT_JITTER_S = 120
+# Housekeeping (watchdog, version report) period while awake
+HOUSEKEEPING_S = 1
 
 # Get LoRa credentials from non-volatile storage
 APP_KEY = pycom.nvs_get('app_key')
@@ -33,26 +58,70 @@ DEVICE_VERSION = get_current_version()
 
 print("starting version: " + DEVICE_VERSION)
 
-lora = LoraNet(LORA_FREQUENCY, LORA_NODE_DR, LORA_REGION, LORA_DEVICE_CLASS, LORA_ACTIVATION, LORA_CRED)
+hwdt = HardwareWatchdog(HW_WDT_TIMEOUT_MS)
+hwdt.register('main', MAIN_MAX_STALL_MS)
+
+lora = LoraNet(LORA_FREQUENCY, LORA_NODE_DR, LORA_REGION, LORA_DEVICE_CLASS, LORA_ACTIVATION, LORA_CRED, hwdt)
 lora.connect()
 
-ota = LoraOTA(lora, DEVICE_VERSION)
+ota = LoraOTA(lora, DEVICE_VERSION, hwdt, REBOOT_JITTER_S, LORA_MULTICAST_DR)
    
-def main():
-   printiton()
-   ota.send_device_version_message()
+async def idle(seconds):
+   # Light sleep when the radio has nothing to do, the CPU and every task are
+   # suspended; otherwise yield to the other tasks
+   if not ota.update_in_progress and lora.radio_idle():
+      machine.sleep(int(seconds * 1000))
+      await asyncio.sleep(0)
+   else:
+      await asyncio.sleep(seconds)
+
+async def telemetry_task():
+   confirmed = False
+   telemetry = TelemetryBuffer(lora.max_payload())
+   last_batch = utime.time()
    while True:
       if not ota.update_in_progress:
          temperature = random_range(-10, 20) # Generate a random temperature between 10 and 30 degrees Celsius
          humidity = random_range(0, 30) # Generate a random humidity between 40 and 70 percent
          print("Temperature:", temperature, "Humidity:", humidity)
-         data ='sensor,' + str(temperature) + ',' + str(humidity)
-         lora.send(data)
-      utime.sleep(5)
+         data = telemetry.add(temperature, humidity)
+         if data is None and utime.time() - last_batch >= TELEMETRY_BATCH_S:
+            data = telemetry.pack()
+            telemetry.clear()
+         if data is not None:
+            lora.queue(data)
+            last_batch = utime.time()
+         if not confirmed and lora.uplinks > 0 and not ota.restart_pending:
+            # The firmware runs and has transmitted a frame, keep it if it
+            # was just updated
+            slots.confirm(RUNNING_SLOT)
+            confirmed = True
+      await idle(TELEMETRY_SAMPLE_S)
+
+async def ota_task():
+   # The version report opens the receive windows in which the server
+   # announces updates; LoraOTA switches to class C once one is announced
+   await asyncio.sleep(eui_jitter(DEV_EUI, REPORT_JITTER_S, 'report'))
+   ota.send_device_version_message()
+   # Lets the server pick deltas for the files this device actually has
+   await ota.report_inventory()
+
+async def housekeeping_task():
+   while True:
+      hwdt.beat('main')
+      hwdt.feed()
+      await asyncio.sleep(HOUSEKEEPING_S)
+
+async def main():
+   printiton()
+   asyncio.create_task(lora.run())
+   asyncio.create_task(ota.run())
+   asyncio.create_task(ota_task())
+   asyncio.create_task(housekeeping_task())
+   await telemetry_task()
 
 try:  
-   main()
+   asyncio.run(main())
 except Exception as e:
    print("Main loop failed: " + str(e))
    ota.revert()
-   
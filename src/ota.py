@@ -22,19 +22,156 @@
 # possibility of such damage.
 
 import diff_match_patch as dmp_module
+import slots
+import journal
+import inventory
+from hashcache import HashCache
 from watchdog import Watchdog
 from machine import RTC
+from machine import Timer
+import micropython
 import ubinascii
 import uhashlib
-import _thread
 import utime
 import uos
 import machine
 import json
+import gc
 from utils import compare_versions
+from utils import eui_jitter
+import airtime
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 import uzlib
 
 
+def mem_free():
+    # gc.mem_free() only exists on MicroPython, the host tests report 0
+    if hasattr(gc, 'mem_free'):
+        return gc.mem_free()
+    return 0
+
+
+class OtaSession:
+
+    # One update campaign. Each session has its own multicast group,
+    # staging directory and inactivity watchdog, so a small update can be
+    # received while a long one is still streaming on another group.
+
+    __slots__ = ('sid', 'state', 'update_in_progress', 'update_version', 'resumes',
+                 'mcAddr', 'mcNwkSKey', 'mcAppSKey', 'staging_dir', 'staging_file',
+                 'partial_file', 'progress_file', 'output_dir', 'patch_size', 'file_to_patch',
+                 'file_hashes', 'staged_patches', 'delete_list', 'checksum_failure', 'device_mainfest',
+                 'wdt', 'apply_pending')
+
+    def __init__(self, sid, on_timeout):
+        self.sid = sid
+        self.state = LoraOTA.IDLE
+        self.update_in_progress = False
+        self.update_version = None
+        self.resumes = 0
+
+        self.mcAddr = None
+        self.mcNwkSKey = None
+        self.mcAppSKey = None
+
+        self.staging_dir = '{}/{}'.format(LoraOTA.STAGING_DIR, sid)
+        self.staging_file = self.staging_dir + '/patches'
+        self.partial_file = self.staging_dir + '/partial'
+        self.progress_file = self.staging_dir + '/progress'
+        # Patched files of the dry run, named after their staged patch
+        self.output_dir = self.staging_dir + '/out'
+
+        # Compressed fragments of the file being received are appended to partial_file
+        self.patch_size = 0
+        self.file_to_patch = None
+        # Hex SHA1 prefixes of the file before and after the patch, empty if not sent
+        self.file_hashes = ('', '')
+        # (filename, offset, length, checksum, pre hash, post hash) of each
+        # verified patch in staging_file
+        self.staged_patches = []
+        self.delete_list = []
+        self.checksum_failure = False
+        self.device_mainfest = None
+
+        self.wdt = Watchdog(lambda: on_timeout(self))
+
+        # Set by the manifest handler, the update is applied by run()
+        self.apply_pending = False
+
+    def clear_staging(self):
+        slots.makedirs(self.staging_dir)
+
+        for path in (self.staging_file, self.partial_file, self.progress_file):
+            try:
+                uos.remove(path)
+            except OSError:
+                pass  # Nothing staged
+        slots.remove_tree(self.output_dir)
+
+        self.staged_patches = []
+        self.delete_list = []
+        self.patch_size = 0
+        self.file_to_patch = None
+        self.file_hashes = ('', '')
+        self.checksum_failure = False
+        self.resumes = 0
+
+    def remove_staging(self):
+        self.clear_staging()
+        try:
+            uos.rmdir(self.staging_dir)
+        except OSError:
+            pass  # Directory already removed
+
+    def save_progress(self):
+        # Written only at file boundaries, fragments are appended to partial_file
+        progress = dict()
+        progress["version"] = self.update_version
+        progress["mc"] = [self.mcAddr, self.mcNwkSKey, self.mcAppSKey]
+        progress["manifest"] = self.device_mainfest
+        progress["staged"] = self.staged_patches
+        progress["delete"] = self.delete_list
+        progress["file"] = self.file_to_patch
+        progress["hashes"] = self.file_hashes
+        # A failed file is counted in the manifest but not staged
+        progress["failed"] = self.checksum_failure
+        progress["resumes"] = self.resumes
+
+        try:
+            with open(self.progress_file, 'w') as fh:
+                fh.write(json.dumps(progress))
+        except Exception as ex:
+            print("Error saving update progress: {}".format(ex))
+
+    def load_progress(self, device_version):
+        try:
+            with open(self.progress_file, 'r') as fh:
+                progress = json.loads(fh.read())
+        except Exception:
+            return False
+
+        if progress["version"] is None or compare_versions(progress["version"], device_version) != 1 or \
+           progress["resumes"] >= LoraOTA.MAX_RESUMES or progress["mc"][0] is None:
+            return False
+
+        self.update_version = progress["version"]
+        self.mcAddr, self.mcNwkSKey, self.mcAppSKey = progress["mc"]
+        self.device_mainfest = progress["manifest"]
+        self.staged_patches = [tuple(staged) for staged in progress["staged"]]
+        self.delete_list = progress["delete"]
+        self.file_to_patch = progress["file"]
+        self.file_hashes = tuple(progress["hashes"])
+        self.checksum_failure = progress.get("failed", False)
+        self.resumes = progress["resumes"] + 1
+        self.patch_size = 0
+
+        return True
+
+
 class LoraOTA:
 
     MSG_HEADER = b'$OTA'
@@ -60,55 +197,165 @@ class LoraOTA:
     DELETE_FILE_MSG = 8
     MANIFEST_MSG = 9
 
-    def __init__(self, lora, device_version):
+    RESUME_MSG = 10
+
+    INVENTORY_MSG = 11
+    INVENTORY_REQUEST = 12
+    INVENTORY_REPLY = 13
+
+    # Update states, a message is only handled in the states listed for its
+    # type in dispatch_table()
+    IDLE = 0
+    OFFERED = 1
+    KEYED = 2
+    RECEIVING_FILE = 3
+    VERIFIED = 4
+    APPLYING = 5
+    STATE_NAMES = ('IDLE', 'OFFERED', 'KEYED', 'RECEIVING_FILE', 'VERIFIED', 'APPLYING')
+
+    # Messages of a session other than 0 carry it after the type: $OTA,6:2,...
+    MAX_SESSIONS = 4
+
+    # Every session is staged in its own numbered directory
+    STAGING_DIR = '/flash/ota_stage'
+
+    # Give up on an update after this many interrupted attempts
+    MAX_RESUMES = 3
+
+    # Shortest hash prefix accepted from the server, in hex digits
+    MIN_HASH_LEN = 8
+
+    WRITE_CHUNK = 512
+
+    # Seconds between checks of the join before resumed sessions time out
+    JOIN_POLL_S = 1
+
+    # Seconds between checks of a scheduled reset
+    REBOOT_CHECK_PERIOD = 1
+
+    # Heartbeat budget of the OTA worker for the hardware watchdog, it beats
+    # while waiting for frames and per file while applying an update
+    HEARTBEAT = 'ota'
+    MAX_STALL_MS = 120000
+
+    def __init__(self, lora, device_version, hwdt = None, reboot_jitter = 0, multicast_dr = 5):
         self.lora = lora
+        self.hwdt = hwdt
+        # DR of the multicast downlinks carrying the fragments, set by the
+        # server and unrelated to the DR of our uplinks
+        self.multicast_dr = multicast_dr
+        # Resets after a multicast manifest are spread over this many seconds
+        self.reboot_jitter = reboot_jitter
+        self._reboot_alarm = None
+        # (ticks_ms when it was planned, delay in ms) of the scheduled reset
+        self._reboot_at = None
+        # Set once a reset is scheduled, no other update is applied until then
+        self.restart_pending = False
         self.device_version = device_version
+        # True while any session is receiving an update
         self.update_in_progress = False
         self.operation_timeout = 10
         self.max_send = 5
 
-        self.mcAddr = None
-        self.mcNwkSKey = None
-        self.mcAppSKey = None
+        # Session number -> OtaSession
+        self.sessions = dict()
 
-        self.patch = b''
-        self.file_to_patch = None
-        self.patch_list = dict()
-        self.checksum_failure = False
-        self.device_mainfest = None
+        self.active_root = slots.active_path()
+        self.active_files = self.load_active_files()
+        # Running file -> SHA1 and the Merkle tree over it, see inventory.py
+        self.inventory = None
+        self._merkle = None
+        self._merkle_paths = None
+        self.hash_cache = HashCache()
+        # Set by dry_run(), see apply_update()
+        self.low_heap = 0
 
         self._exit = False
 
-        # Watchdog
         self.inactivity_timeout = 60
-        self.wdt = Watchdog()
-        
-        self.lora.init(self.process_message)
-        
-
-    def delete_backup_files(self):
-        # deleting remaining backup files
-        for file in uos.listdir("/flash"):
-            if file.endswith(".bak"):
-                print("deleting bak file: " + file)
-                uos.remove(file)
+
+        # (from, to) -> number of transitions, message type -> rejected messages
+        self.transitions = dict()
+        self.rejected = dict()
+        self._dispatch = self.dispatch_table()
+
+        self.resume_update()
+
+
+    def new_session(self, sid):
+        return OtaSession(sid, self.inactivity_expired)
+
+    def update_link_class(self):
+        # Class C is kept while any session is receiving an update
+        self.update_in_progress = False
+        for session in self.sessions.values():
+            if session.update_in_progress:
+                self.update_in_progress = True
+        self.lora.set_class_c(self.update_in_progress)
+
+    def resume_update(self):
+        slots.makedirs(self.STAGING_DIR)
+
+        for name in uos.listdir(self.STAGING_DIR):
+            try:
+                sid = int(name)
+            except ValueError:
+                sid = -1
+            if not 0 <= sid < self.MAX_SESSIONS:
+                # Not a session directory
+                slots.remove_tree(self.STAGING_DIR + '/' + name)
+                continue
+
+            session = self.new_session(sid)
+            if not session.load_progress(self.device_version):
+                session.remove_staging()
+                continue
+
+            if session.file_to_patch is not None:
+                session.patch_size = self.file_size(session.partial_file)
+            session.update_in_progress = True
+            self.sessions[sid] = session
+
+        if not self.sessions:
+            return
+
+        # Switching class reinitialises the radio, so it is done before
+        # joining the multicast groups
+        self.update_link_class()
+
+        for session in self.sessions.values():
+            print("Resuming update {} to version {} (attempt {})".format(session.sid, session.update_version, session.resumes))
+            session.save_progress()
+
+            self.lora.change_to_multicast_mode((session.mcAddr, session.mcNwkSKey, session.mcAppSKey))
+            # The inactivity watchdog is started by run() once joined
+
+            self.send_resume_msg(session)
+
+            if session.file_to_patch is not None:
+                self.set_state(session, self.RECEIVING_FILE)
+            elif session.staged_patches or session.delete_list:
+                self.set_state(session, self.VERIFIED)
+            else:
+                self.set_state(session, self.KEYED)
 
     def stop(self):
         self.lora.stop()
         self._exit = True
 
-    def change_to_listening_mode(self):
-        if self.mcAddr is not None:
-            multicast_auth = (self.mcAddr, self.mcNwkSKey, self.mcAppSKey)
+    def change_to_listening_mode(self, session):
+        if session.mcAddr is not None:
+            multicast_auth = (session.mcAddr, session.mcNwkSKey, session.mcAppSKey)
             self.lora.change_to_multicast_mode(multicast_auth)
-            self.device_mainfest = self.create_device_manifest()
+            session.device_mainfest = self.create_device_manifest()
+            session.save_progress()
 
-            self.send_listening_msg()
+            self.send_listening_msg(session)
 
             # iniciar thread para checkear si update failed? como en thread_proc?
 
         else:
-            self.reset_update_params()
+            self.reset_update_params(session)
 
     def create_device_manifest(self):
 
@@ -119,12 +366,26 @@ class LoraOTA:
 
         return manifest
 
-    def reset_update_params(self):
-        self.mcAddr = None
-        self.mcNwkSKey = None
-        self.mcAppSKey = None
+    def reset_update_params(self, session):
+        session.wdt.cancel()
+        session.update_in_progress = False
+        session.mcAddr = None
+        session.mcNwkSKey = None
+        session.mcAppSKey = None
+
+        session.update_version = '0.0.0'
+        session.remove_staging()
+        self.set_state(session, self.IDLE)
 
-        self.update_version = '0.0.0'
+        if self.sessions.get(session.sid) is session:
+            del self.sessions[session.sid]
+        self.update_link_class()
+
+    def msg_type_field(self, msg_type, session):
+        # Session 0 is left out, older servers only know about one session
+        if session is None or session.sid == 0:
+            return str(msg_type).encode()
+        return '{}:{}'.format(msg_type, session.sid).encode()
 
     def send_device_version_message(self):
         # $OTA,0,1.0.1,*
@@ -134,44 +395,142 @@ class LoraOTA:
         msg.extend(b',' + self.device_version.encode())
         msg.extend(b',' + self.MSG_TAIL)
 
-        self.lora.send(msg)
+        self.lora.queue(msg, self.lora.PRIO_OTA)
 
-    def send_update_info_reply(self):
+    def send_update_info_reply(self, session):
         # $OTA,2,1.0.1,*
         msg = bytearray()
         msg.extend(self.MSG_HEADER)
-        msg.extend(b',' + str(self.UPDATE_INFO_REPLY).encode())
+        msg.extend(b',' + self.msg_type_field(self.UPDATE_INFO_REPLY, session))
         msg.extend(b',' + self.device_version.encode())
         msg.extend(b',' + self.MSG_TAIL)
 
-        self.lora.send(msg)
+        self.lora.queue(msg, self.lora.PRIO_OTA)
 
-    def send_listening_msg(self):
-        # $OTA,4,*
+    def send_resume_msg(self, session):
+        # $OTA,10,1.0.2,2,main.py,1536,*
+        # version, number of files already verified, file being received and
+        # bytes of it already received
         msg = bytearray()
         msg.extend(self.MSG_HEADER)
-        msg.extend(b',' + str(self.LISTENING_MSG).encode())
+        msg.extend(b',' + self.msg_type_field(self.RESUME_MSG, session))
+        msg.extend(b',' + session.update_version.encode())
+        msg.extend(b',' + str(len(session.staged_patches)).encode())
+        msg.extend(b',' + (session.file_to_patch or '').encode())
+        msg.extend(b',' + str(session.patch_size).encode())
         msg.extend(b',' + self.MSG_TAIL)
 
-        self.lora.send(msg)
+        self.lora.queue(msg, self.lora.PRIO_NACK)
+
+    def send_listening_msg(self, session):
+        # $OTA,4,213,*
+        # Fragment size in bytes that fills a multicast downlink
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + self.msg_type_field(self.LISTENING_MSG, session))
+        msg.extend(b',' + str(airtime.fragment_size(self.multicast_dr, session.sid)).encode())
+        msg.extend(b',' + self.MSG_TAIL)
+
+        self.lora.queue(msg, self.lora.PRIO_OTA)
+
+    def send_inventory_msg(self):
+        # $OTA,11,1.0.1,42,0f1e2d3c4b5a6978,*
+        # Number of files and truncated Merkle root of the running slot
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + str(self.INVENTORY_MSG).encode())
+        msg.extend(b',' + self.device_version.encode())
+        msg.extend(b',' + str(len(self.inventory)).encode())
+        msg.extend(b',' + inventory.hex_hash(self._merkle[-1][0]).encode())
+        msg.extend(b',' + self.MSG_TAIL)
+
+        self.lora.queue(msg, self.lora.PRIO_OTA)
+
+    def send_inventory_reply(self, level, index, data):
+        # $OTA,13,<level>,<index>,<data>,*
+        msg = bytearray()
+        msg.extend(self.MSG_HEADER)
+        msg.extend(b',' + str(self.INVENTORY_REPLY).encode())
+        msg.extend(b',' + str(level).encode())
+        msg.extend(b',' + str(index).encode())
+        msg.extend(b',' + data.encode())
+        msg.extend(b',' + self.MSG_TAIL)
+
+        self.lora.queue(msg, self.lora.PRIO_OTA)
+
+    async def load_inventory(self):
+        # Only hashes the running files when the slot has no stored inventory
+        slot = slots.active_slot()
+        hashes = inventory.read(slot)
+        if hashes is None or len(hashes) != len(self.active_files):
+            # Unchanged files are looked up in the hash cache
+            hashes = dict()
+            for filename in self.active_files:
+                await asyncio.sleep(0)
+                hashes[filename] = self.hash_cache.get(self.active_root + '/' + filename)
+            print("Hash cache: {} hits, {} misses".format(self.hash_cache.hits, self.hash_cache.misses))
+            self.hash_cache.save()
+            if slot != slots.ROOT_SLOT:
+                inventory.write(slot, hashes)
+
+        self.inventory = hashes
+        self._merkle, self._merkle_paths = inventory.merkle_levels(hashes)
+
+    async def report_inventory(self):
+        if self.inventory is None:
+            await self.load_inventory()
+        self.send_inventory_msg()
+
+    def process_inventory_request(self, msg):
+        # $OTA,12,<level>,<index>,*
+        # Level 0 are the files, the reply holds the path and the truncated
+        # hash of the file. Above it the reply holds the truncated hashes of
+        # the children of the node.
+        if self._merkle is None:
+            return
 
-    def file_exists(self, file_path):
-        exists = False
-        try:
-            if uos.stat(file_path)[6] > 0:
-                exists = True
-        except Exception as e:
-            exists = False
-        return exists
-
-    def get_msg_type(self, msg):
-        msg_type = -1
         try:
-            msg_type = int(msg.split(b',')[1].decode())
+            token_msg = msg.split(",")
+            level = int(token_msg[2])
+            index = int(token_msg[3])
+            if level == 0:
+                path = self._merkle_paths[index]
+                data = '{},{}'.format(path, inventory.hex_hash(self.inventory[path]))
+            else:
+                children = self._merkle[level - 1][2 * index:2 * index + 2]
+                data = ','.join([inventory.hex_hash(child) for child in children])
         except Exception as ex:
-            print("Exception getting message type")
+            print("Exception getting inventory request: {}".format(ex))
+            return
 
-        return msg_type
+        self.send_inventory_reply(level, index, data)
+
+    def file_size(self, file_path):
+        try:
+            return uos.stat(file_path)[6]
+        except OSError:
+            return 0
+
+    def load_active_files(self):
+        files = slots.read_index(slots.active_slot())
+        if files is None:
+            files = slots.walk(self.active_root)
+        # Slots built before the root modules were reserved still list them
+        return set([filename for filename in files if filename not in slots.ROOT_MODULES])
+
+    def parse_header(self, msg):
+        # $OTA,<type>[:<session>],... -> (type, session), only the type
+        # field is parsed, the payload is left untouched
+        start = len(self.MSG_HEADER) + 1
+        try:
+            field = msg[start:msg.index(b',', start)]
+            idx = field.find(b':')
+            if idx < 0:
+                return int(field), 0
+            return int(field[:idx]), int(field[idx + 1:])
+        except Exception:
+            print("Exception getting message type")
+            return -1, 0
 
     def sync_clock(self, epoc):
         try:
@@ -183,40 +542,49 @@ class LoraOTA:
 
         return True
 
-    def parse_update_info_msg(self, msg):
+    def parse_update_info_msg(self, session, msg):
         # $OTA,1,1.0.2,1674930013,*
-        self.resp_received = True
+        previous_version = session.update_version
 
         try:
             token_msg = msg.split(",")
             if compare_versions(token_msg[2], self.device_version) == 1:
-                self.update_in_progress = True
-                self.update_version = token_msg[2]
-                self.wdt.enable(self.inactivity_timeout)
-                self.start_watchdog_thread()
+                if token_msg[2] != session.update_version:
+                    # A different update than the one being resumed
+                    session.clear_staging()
+                    session.update_version = token_msg[2]
+                    session.wdt.reset_stats()
+                if not session.update_in_progress:
+                    session.update_in_progress = True
+                    self.update_link_class()
+                    session.wdt.enable(self.inactivity_timeout)
 
             if utime.time() < 1550000000:
                 self.sync_clock(int(token_msg[3]))
 
         except Exception as ex:
             print("Exception getting update information: {}".format(ex))
-            return False
+            return None
 
-        self.send_update_info_reply()
+        self.send_update_info_reply(session)
 
-        return True
+        if not session.update_in_progress:
+            return None
+        if session.state == self.IDLE or session.update_version != previous_version:
+            return self.OFFERED
+        return None
 
-    def parse_multicast_keys(self, msg):
+    def parse_multicast_keys(self, session, msg):
         # $OTA,3,mcAddr,mcNwkSKey,mcAppSKey,*
         try:
             token_msg = msg.split(",")
 
             if len(token_msg[2]) > 0:
-                self.mcAddr = token_msg[2]
-                self.mcNwkSKey = token_msg[3]
-                self.mcAppSKey = token_msg[4]
+                session.mcAddr = token_msg[2]
+                session.mcNwkSKey = token_msg[3]
+                session.mcAppSKey = token_msg[4]
 
-            print("mcAddr: {}, mcNwkSKey: {}, mcAppSKey: {}".format(self.mcAddr, self.mcNwkSKey, self.mcAppSKey))
+            print("mcAddr: {}, mcNwkSKey: {}, mcAppSKey: {}".format(session.mcAddr, session.mcNwkSKey, session.mcAppSKey))
 
         except Exception as ex:
             print("Exception getting multicast keys: {}".format(ex))
@@ -224,6 +592,13 @@ class LoraOTA:
 
         return True
 
+    def process_multicast_keys_msg(self, session, msg):
+        self.parse_multicast_keys(session, msg)
+        self.change_to_listening_mode(session)
+        if session.mcAddr is None:
+            return None
+        return self.KEYED
+
     def get_msg_data(self, msg):
         data = None
         try:
@@ -234,12 +609,22 @@ class LoraOTA:
             print("Exception getting msg data: {}".format(ex))
         return data
 
-    def process_patch_msg(self, msg):
+    def process_patch_msg(self, session, msg):
         # $OTA,6, patch_data,*
-        partial_patch = msg[7:-2]
+        partial_patch = msg[msg.index(b',', len(self.MSG_HEADER) + 1) + 1:-2]
 
         if partial_patch:
-            self.patch += partial_patch
+            with open(session.partial_file, 'ab') as fh:
+                fh.write(partial_patch)
+            session.patch_size += len(partial_patch)
+
+    def hexdigest(self, h):
+        return ubinascii.hexlify(h.digest()).decode()
+
+    def hash_matches(self, digest, expected):
+        # The server may send a prefix of the hash to save airtime, in
+        # either case
+        return len(expected) >= self.MIN_HASH_LEN and digest.startswith(expected.lower())
 
     def verify_patch(self, patch, received_checksum):
         h = uhashlib.sha1()
@@ -248,147 +633,273 @@ class LoraOTA:
         print("Computed checksum: {}".format(checksum))
         print("Received checksum: {}".format(received_checksum))
 
-        if checksum != received_checksum:
-            self.checksum_failure = True
+        return checksum == received_checksum
+
+    def stage_patch(self, session, filename, patch, checksum):
+        # The file size is used as offset, a reset after a previous append
+        # may have left bytes that are not listed in staged_patches
+        offset = self.file_size(session.staging_file)
+        try:
+            with open(session.staging_file, 'ab') as fh:
+                fh.write(patch)
+        except Exception as ex:
+            print("Error staging patch: {}".format(ex))
             return False
 
+        pre, post = session.file_hashes
+        session.staged_patches.append((filename, offset, len(patch), checksum, pre, post))
         return True
 
-    def process_checksum_msg(self, msg):
+    def read_staged_patch(self, session, offset, length):
+        with open(session.staging_file, 'rb') as fh:
+            fh.seek(offset)
+            return fh.read(length)
+
+    def process_checksum_msg(self, session, msg):
         checksum = self.get_msg_data(msg)
         # Decompress patch
-        decompressed_patch = uzlib.decompress(self.patch)
-        self.patch = decompressed_patch.decode()
-        verified = self.verify_patch(self.patch, checksum)
-        if verified:
-            self.patch_list[self.file_to_patch] = self.patch
-
-        self.file_to_patch = None
-        self.patch = b''
-
-    def backup_file(self, filename):
-        bak_path = "{}.bak".format(filename)
+        try:
+            with open(session.partial_file, 'rb') as fh:
+                decompressed_patch = uzlib.decompress(fh.read())
+        except Exception as ex:
+            print("Error decompressing patch: {}".format(ex))
+            decompressed_patch = b''
+        if self.verify_patch(decompressed_patch, checksum) and \
+           self.stage_patch(session, session.file_to_patch, decompressed_patch, checksum):
+            # Progress was made, interrupted attempts are counted from here
+            session.resumes = 0
+        else:
+            session.checksum_failure = True
 
-        # Delete previous backup if it exists
         try:
-            uos.remove(bak_path)
+            uos.remove(session.partial_file)
         except OSError:
-            pass  # There isnt a previous backup
-
-        # Backup current file
-        uos.rename(filename, bak_path)
-        
-    def del_file(self, filename):
-        del_path = "{}.del".format(filename)
-        open(del_path, 'w+')  # Create file
-
-    def process_delete_msg(self, msg):
+            pass  # No fragments were received
+        session.patch_size = 0
+        session.file_to_patch = None
+        session.file_hashes = ('', '')
+        session.save_progress()
+        return self.VERIFIED
+
+    def process_delete_msg(self, session, msg):
         filename = self.get_msg_data(msg)
         print("Deleting file: {}".format(filename))
-        if self.file_exists('/flash/' + filename):
-            self.backup_file('/flash/' + filename)
-            self.device_mainfest["delete"] += 1
-
-    def get_tmp_filename(self, filename):
-        idx = filename.rfind(".")
-        return filename[:idx + 1] + "tmp"
+        if filename in self.active_files:
+            # Deleted files are simply left out of the new slot
+            session.delete_list.append(filename)
+            session.device_mainfest["delete"] += 1
+            session.save_progress()
+        return None
 
     def _read_file(self, filename):
-
+        # Returns the text of a running file and the hex SHA1 of its content,
+        # hashed from the buffer it is read into
+        path = self.active_root + '/' + filename
         try:
-            with open('/flash/' + filename, 'r') as fh:
-                return fh.read()
+            data = bytearray(self.file_size(path))
+            with open(path, 'rb') as fh:
+                fh.readinto(data)
+            h = uhashlib.sha1()
+            h.update(data)
+            return str(data, 'utf-8'), self.hexdigest(h)
         except Exception as ex:
             print("Error reading file: {}".format(ex))
 
-        return None
+        return None, None
 
-    def _write_to_file(self, filename, text):
-        tmp_file = self.get_tmp_filename('/flash/' + filename)
+    def _write_to_file(self, path, text):
+        # Returns the hex SHA1 of the written content, hashed chunk by chunk
+        # while it is written, or None on error
+        idx = path.rfind('/')
+        slots.makedirs(path[:idx])
 
+        h = uhashlib.sha1()
         try:
-            with open(tmp_file, 'w+') as fh:
-                fh.write(text)
+            with open(path, 'wb') as fh:
+                for start in range(0, len(text), self.WRITE_CHUNK):
+                    chunk = text[start:start + self.WRITE_CHUNK].encode()
+                    h.update(chunk)
+                    fh.write(chunk)
         except Exception as ex:
             print("Error writing to file: {}".format(ex))
-            return False
-
-        if self.file_exists('/flash/' + filename):
-            self.backup_file('/flash/' + filename)
-        else:
-            self.del_file('/flash/' + filename)
-        uos.rename(tmp_file, '/flash/' + filename)
-
-        return True
-
-    def apply_patches(self):
-        for key, value in self.patch_list.items():
-            self.dmp = dmp_module.diff_match_patch()
-            patches_list = self.dmp.patch_fromText(value)
+            return None
+
+        return self.hexdigest(h)
+
+    async def prepare_slot(self, session, target):
+        # Start the new slot as a copy of the running tree, except for the
+        # files that are going to be patched or deleted
+        target_root = slots.slot_path(target)
+        slots.clear_slot(target)
+        slots.makedirs(target_root)
+
+        patched = [staged[0] for staged in session.staged_patches]
+        skip = set(session.delete_list)
+        skip.update(patched)
+        copied = [filename for filename in self.active_files if filename not in skip]
+
+        # The index is written first so that a later build can clean up
+        # whatever an interrupted one left behind
+        slots.write_index(target, copied + patched)
+
+        for filename in copied:
+            self.heartbeat()
+            await asyncio.sleep(0)
+            crc = slots.copy_file(self.active_root + '/' + filename, target_root + '/' + filename)
+            journal.record_file(filename, crc)
+            self.hash_cache.put(target_root + '/' + filename, self.inventory[filename])
+
+    def output_path(self, session, idx):
+        return '{}/{}'.format(session.output_dir, idx)
+
+    async def dry_run(self, session):
+        # Every patch is applied to a staged output before anything outside
+        # the staging directory is touched, a patch that does not apply
+        # costs neither the rollback slot nor a reset
+        slots.remove_tree(session.output_dir)
+
+        # SHA1 of each output, for the inventory of the new slot
+        digests = []
+        # Lowest free heap while the parsed patches are alive
+        self.low_heap = mem_free()
+
+        # One engine for the whole update, its tables are built only once
+        dmp = dmp_module.diff_match_patch()
+        for idx, (key, offset, length, checksum, pre, post) in enumerate(session.staged_patches):
+            self.heartbeat()
+            await asyncio.sleep(0)
+            # Only one patch is held in memory at a time
+            value = self.read_staged_patch(session, offset, length)
+            if not self.verify_patch(value, checksum):
+                return None
+
+            patches_list = dmp.patch_fromTextCompact(value.decode())
+            value = None
 
             to_patch = ''
+            source_hash = self.hexdigest(uhashlib.sha1())
             print('Updating file: {}'.format(key))
-            if self.file_exists('/flash/' + key):
-                to_patch = self._read_file(key)
-
-            patched_text, success = self.dmp.patch_apply(patches_list, to_patch)
+            if key in self.active_files:
+                to_patch, source_hash = self._read_file(key)
+                if to_patch is None:
+                    return None
+
+            if pre and self.hash_matches(source_hash, pre):
+                # The file is the one the patch was made from, the patches
+                # are applied at their location without fuzzy matching
+                patched_text, success = dmp.patch_applyExact(patches_list, to_patch)
+            else:
+                if pre:
+                    print('{} differs from the base of its patch'.format(key))
+                # The parsed patches are not needed afterwards, they are
+                # applied without a copy
+                patched_text, success = dmp.patch_applyInPlace(patches_list, to_patch)
+            self.low_heap = min(self.low_heap, mem_free())
+            patches_list = None
+            to_patch = None
             if False in success:
-                return False
-
-            if not self._write_to_file(key, patched_text):
-                return False
-        
-        print("printing backup files")
-        for file in uos.listdir("/flash"):
-            if file.endswith(".bak"):
-                print(file)
+                print('Patch of {} does not apply'.format(key))
+                return None
+
+            digest = self._write_to_file(self.output_path(session, idx), patched_text)
+            patched_text = None
+            if digest is None:
+                return None
+            if post and not self.hash_matches(digest, post):
+                print('Patched {} does not match its target hash'.format(key))
+                return None
+            digests.append(ubinascii.unhexlify(digest))
+
+        return digests
+
+    async def build_slot(self, session, target, digests):
+        # Copies the running tree and the dry run outputs to the target slot
+        target_root = slots.slot_path(target)
+        try:
+            inventory.remove(target)
+            if self.inventory is None:
+                await self.load_inventory()
+            self.hash_cache.drop(target_root + '/')
+
+            await self.prepare_slot(session, target)
+
+            for idx, staged in enumerate(session.staged_patches):
+                self.heartbeat()
+                await asyncio.sleep(0)
+                path = target_root + '/' + staged[0]
+                crc = slots.copy_file(self.output_path(session, idx), path)
+                journal.record_file(staged[0], crc)
+                self.hash_cache.put(path, digests[idx])
+
+            # Copied files keep their hash, only the patched ones are new
+            hashes = dict(self.inventory)
+            for filename in session.delete_list:
+                hashes.pop(filename, None)
+            for idx, staged in enumerate(session.staged_patches):
+                hashes[staged[0]] = digests[idx]
+            inventory.write(target, hashes)
+            self.hash_cache.save()
+        except Exception as ex:
+            print("Error building slot {}: {}".format(target, ex))
+            return False
 
         return True
 
-    @staticmethod
-    def find_backups():
-        backups = []
-        for file in uos.listdir("/flash"):
-            if file.endswith(".bak"):
-                backups.append(file)
-        return backups
-
-    @staticmethod
-    def find_dels():
-        dels = []
-        for file in uos.listdir("/flash"):
-            if file.endswith(".del"):
-                dels.append(file)
-        return dels
-
-    @staticmethod
-    def revert():
-        backup_list = LoraOTA.find_backups()
-        for backup in backup_list:
-            idx = backup.find('.bak')
-            new_filename = backup[:idx]
-            uos.rename(backup, new_filename)
-        for del_file in LoraOTA.find_dels():
-            idx = del_file.find('.del')
-            uos.remove(del_file[:idx])
-            uos.remove(del_file)
-        print('Error: Reverting to old firmware')
+    def restart(self):
+        # Planned reset, the LoRaWAN session is kept so the device does not rejoin
+        self.restart_pending = True
+        self.lora.save_session()
         machine.reset()
 
-    def manifest_failure(self, msg):
+    def jittered_restart(self):
+        # Every device of the multicast group gets the manifest at once, each
+        # one waits its own delay so they do not all rejoin and report together
+        self.restart_pending = True
+        delay = eui_jitter(self.lora.get_dev_eui(), self.reboot_jitter, 'reboot')
+        if delay < 1:
+            self.restart()
+            return
+
+        print("Restarting in {} s".format(int(delay)))
+        self._reboot_at = (utime.ticks_ms(), int(delay * 1000))
+        # Checked periodically like Watchdog._check, so a restart that cannot
+        # be scheduled yet is not lost
+        self._reboot_alarm = Timer.Alarm(self._reboot_check, s = self.REBOOT_CHECK_PERIOD, periodic = True)
+
+    def _reboot_check(self, alarm):
+        start, delay = self._reboot_at
+        if utime.ticks_diff(utime.ticks_ms(), start) < delay:
+            return
+        try:
+            micropython.schedule(self._scheduled_restart, None)
+        except RuntimeError:
+            return  # Schedule queue is full, retry on the next period
+        alarm.cancel()
+
+    def _scheduled_restart(self, arg):
+        self.restart()
+
+    def revert(self):
+        if slots.rollback():
+            print('Error: Reverting to old firmware')
+        else:
+            print('Error: No previous firmware to revert to')
+        self.restart()
+
+    def manifest_failure(self, session, msg):
 
         try:
             start_idx = msg.find("{")
             stop_idx = msg.find("}")
 
-            recv_manifest = json.loads(msg[start_idx:stop_idx])
+            recv_manifest = json.loads(msg[start_idx:stop_idx + 1])
 
             print("Received manifest: {}".format(recv_manifest))
-            print("Actual manifest: {}".format(self.device_mainfest))
+            print("Actual manifest: {}".format(session.device_mainfest))
 
-            if (recv_manifest["update"] != self.device_mainfest["update"]) or \
-               (recv_manifest["new"] != self.device_mainfest["new"]) or \
-               (recv_manifest["delete"] != self.device_mainfest["delete"]):
+            if (recv_manifest["update"] != session.device_mainfest["update"]) or \
+               (recv_manifest["new"] != session.device_mainfest["new"]) or \
+               (recv_manifest["delete"] != session.device_mainfest["delete"]):
                 return True
         except Exception as ex:
             print("Error in manifest: {}".format(ex))
@@ -396,62 +907,237 @@ class LoraOTA:
 
         return False
 
-    def process_manifest_msg(self, msg):
-        if self.manifest_failure(msg):
+    def discard_update(self, session):
+        # Nothing outside the staging directory was touched, the device
+        # keeps running without a reset
+        self.reset_update_params(session)
+
+    def process_manifest_msg(self, session, msg):
+        # The transfer is over, applying the update may take longer than the timeout
+        session.wdt.cancel()
+        print("Downlink cadence: {}".format(session.wdt.stats()))
+        print("OTA states: {}".format(self.state_stats()))
+
+        if self.manifest_failure(session, msg):
             print('Manifest failure: Discarding update ...')
-            self.reset_update_params()
-            machine.reset()
-        elif self.checksum_failure:
+            self.discard_update(session)
+            return None
+        if session.checksum_failure:
             print('Failed checksum: Discarding update ...')
-            self.reset_update_params()
-            machine.reset()
-        elif not self.apply_patches():
-            LoraOTA.revert()
+            self.discard_update(session)
+            return None
+
+        # Building the slot takes a while, run() does it between other tasks
+        session.apply_pending = True
+        return self.APPLYING
+
+    async def apply_update(self, session):
+        gc.collect()
+        print("Free heap before applying: {}".format(mem_free()))
+        digests = await self.dry_run(session)
+        print("Lowest free heap while applying: {}".format(self.low_heap))
+        gc.collect()
+        print("Free heap after applying: {}".format(mem_free()))
+
+        if digests is None:
+            print('Failed to apply patches: Discarding update ...')
+            self.discard_update(session)
+            return
+
+        # The slot we are about to overwrite can no longer be rolled back to
+        target = slots.inactive_slot()
+        slots.invalidate_previous()
+        journal.begin(target)
+
+        if not await self.build_slot(session, target, digests):
+            print('Failed to build the update: Discarding update ...')
+            journal.clear()
+            self.discard_update(session)
         else:
-            print('Update Success: Restarting .... ')   
-            machine.reset()
-
-    def process_filename_msg(self, msg):
-        self.file_to_patch = self.get_msg_data(msg)
+            # From here on a reset rolls the update forward at boot
+            journal.commit()
+            slots.activate(target)
+            journal.clear()
+            self.reset_update_params(session)
+            print('Update Success: Restarting .... ')
+            self.jittered_restart()
+
+    def process_filename_msg(self, session, msg):
+        # $OTA,5,main.py,<pre hash>,<post hash>,*
+        # The hashes are hex SHA1 prefixes of the file before and after the
+        # patch, older servers only send the filename
+        fields = self.get_msg_data(msg).split(',')
+        filename = fields[0]
+        hashes = (fields[1] if len(fields) > 1 else '', fields[2] if len(fields) > 2 else '')
+
+        if filename == session.file_to_patch:
+            # The server continues a resumed file from the offset we reported
+            print("Resume file: {} at {}".format(filename, session.patch_size))
+            session.wdt.enable(self.inactivity_timeout)
+            return self.RECEIVING_FILE
+
+        if session.file_to_patch is not None:
+            # The checksum of the previous file was lost. It is already
+            # counted in the manifest but was never staged, so the counts
+            # would match without it.
+            print("No checksum received for {}".format(session.file_to_patch))
+            session.checksum_failure = True
+
+        session.file_to_patch = filename
+        session.file_hashes = hashes
+        try:
+            uos.remove(session.partial_file)
+        except OSError:
+            pass  # No fragments were received
+        session.patch_size = 0
 
-        if self.file_exists('/flash/' + self.file_to_patch):
-            self.device_mainfest["update"] += 1
-            print("Update file: {}".format(self.file_to_patch))
+        if session.file_to_patch in self.active_files:
+            session.device_mainfest["update"] += 1
+            print("Update file: {}".format(session.file_to_patch))
         else:
-            self.device_mainfest["new"] += 1
-            print("Create new file: {}".format(self.file_to_patch))
-
-        self.wdt.enable(self.inactivity_timeout)
-
-    def start_watchdog_thread(self):
-        _thread.start_new_thread(self._check_timeout, ())
-        
-    def _check_timeout(self):
-        while True:
-            if self.wdt.update_failed():
-                
-                print("Inactivity timeout: Reverting to old firmware")
-                LoraOTA.revert()
-            utime.sleep(1)
+            session.device_mainfest["new"] += 1
+            print("Create new file: {}".format(session.file_to_patch))
+
+        session.save_progress()
+        session.wdt.enable(self.inactivity_timeout)
+        return self.RECEIVING_FILE
+
+    def inactivity_expired(self, session):
+        # Only this session stalled, the others keep streaming. The server
+        # is asked to resume it from what was received, and the session is
+        # dropped after MAX_RESUMES attempts without progress.
+        print("Inactivity timeout in session {}".format(session.sid))
+        print("Downlink cadence: {}".format(session.wdt.stats()))
+        session.resumes += 1
+        if session.resumes >= self.MAX_RESUMES:
+            print("Update {} is not progressing: Discarding it ...".format(session.sid))
+            self.discard_update(session)
+            return
+
+        session.save_progress()
+        self.send_resume_msg(session)
+        session.wdt.enable(self.inactivity_timeout)
+
+    def heartbeat(self):
+        if self.hwdt is not None:
+            self.hwdt.beat(self.HEARTBEAT)
+
+    def set_state(self, session, state):
+        if state is None or state == session.state:
+            return
+        key = (session.state, state)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+        print("OTA session {}: {} -> {}".format(session.sid, self.STATE_NAMES[session.state], self.STATE_NAMES[state]))
+        session.state = state
+
+    def state_stats(self):
+        # Transition and rejection counts, for profiling a campaign
+        transitions = dict()
+        for (src, dst), count in self.transitions.items():
+            transitions[self.STATE_NAMES[src] + '>' + self.STATE_NAMES[dst]] = count
+        states = dict()
+        for sid, session in self.sessions.items():
+            states[sid] = self.STATE_NAMES[session.state]
+        return {"sessions": states, "transitions": transitions, "rejected": self.rejected}
+
+    def dispatch_table(self):
+        # Message type -> (handler, mask of the states accepting it). Handlers
+        # return the next state, or None to stay in the current one. Messages
+        # that are not part of an update session have no mask.
+        def accepted(*states):
+            mask = 0
+            for state in states:
+                mask |= 1 << state
+            return mask
+
+        table = [None] * (self.INVENTORY_REQUEST + 1)
+        table[self.UPDATE_INFO_MSG] = (self.parse_update_info_msg,
+            accepted(self.IDLE, self.OFFERED, self.KEYED, self.RECEIVING_FILE, self.VERIFIED))
+        table[self.MULTICAST_KEY_MSG] = (self.process_multicast_keys_msg,
+            accepted(self.OFFERED, self.KEYED))
+        # A filename while receiving a file means its checksum was lost, the
+        # update is then discarded when the manifest arrives
+        table[self.UPDATE_TYPE_FNAME] = (self.process_filename_msg,
+            accepted(self.KEYED, self.RECEIVING_FILE, self.VERIFIED))
+        table[self.UPDATE_TYPE_PATCH] = (self.process_patch_msg,
+            accepted(self.RECEIVING_FILE))
+        table[self.UPDATE_TYPE_CHECKSUM] = (self.process_checksum_msg,
+            accepted(self.RECEIVING_FILE))
+        table[self.DELETE_FILE_MSG] = (self.process_delete_msg,
+            accepted(self.KEYED, self.VERIFIED))
+        table[self.MANIFEST_MSG] = (self.process_manifest_msg,
+            accepted(self.KEYED, self.VERIFIED))
+        table[self.INVENTORY_REQUEST] = (self.process_inventory_request, None)
+        return table
 
     def process_message(self, msg):
-        self.wdt.ack()
-
-        msg_type = self.get_msg_type(msg)
+        # A handler that fails, e.g. on a malformed frame, only loses that
+        # frame, the worker goes on with the next one
+        try:
+            self.dispatch_message(msg)
+        except Exception as ex:
+            print("Error handling OTA message: {}".format(ex))
+
+    async def run(self):
+        # Handles the OTA frames received by LoraNet. The worker also beats
+        # while it waits for frames, so the hardware watchdog is no longer
+        # fed once it has died.
+        if self.hwdt is not None:
+            self.hwdt.register(self.HEARTBEAT, self.MAX_STALL_MS)
+
+        # No frame of a resumed session can arrive before the network is
+        # joined, which may take several join attempts
+        while not self.lora.joined():
+            self.heartbeat()
+            await asyncio.sleep(self.JOIN_POLL_S)
+        for session in self.sessions.values():
+            session.wdt.enable(self.inactivity_timeout)
+
+        async for msg in self.lora.frames(self.heartbeat):
+            self.heartbeat()
+            self.process_message(msg)
+
+            for session in list(self.sessions.values()):
+                # Once a reset is scheduled the other sessions stay staged
+                # and are applied after it
+                if not session.apply_pending or self.restart_pending:
+                    continue
+                session.apply_pending = False
+                try:
+                    await self.apply_update(session)
+                except Exception as ex:
+                    # A journal left behind is dealt with by recover() at boot
+                    print("Error applying update {}: {}".format(session.sid, ex))
+                    self.discard_update(session)
+
+    def dispatch_message(self, msg):
+        msg_type, sid = self.parse_header(msg)
+        entry = None
+        if 0 <= msg_type < len(self._dispatch) and 0 <= sid < self.MAX_SESSIONS:
+            entry = self._dispatch[msg_type]
+
+        if entry is not None and entry[1] is None:
+            entry[0](msg.decode())
+            return
+
+        # Stray or replayed frames are dropped before they are decoded, and
+        # do not keep the inactivity watchdog alive
+        session = self.sessions.get(sid)
+        state = self.IDLE if session is None else session.state
+        if entry is None or not entry[1] & (1 << state):
+            self.rejected[msg_type] = self.rejected.get(msg_type, 0) + 1
+            return
+
+        if session is None:
+            # Only an update offer is accepted in IDLE, it opens the session
+            session = self.new_session(sid)
+            self.sessions[sid] = session
+
+        session.wdt.ack()
         if msg_type != self.UPDATE_TYPE_PATCH:
             msg = msg.decode()
-        if msg_type == self.UPDATE_INFO_MSG:
-            self.parse_update_info_msg(msg)
-        elif msg_type == self.MULTICAST_KEY_MSG:
-            self.parse_multicast_keys(msg)
-            self.change_to_listening_mode()
-        elif msg_type == self.UPDATE_TYPE_FNAME:
-            self.process_filename_msg(msg)
-        elif msg_type == self.UPDATE_TYPE_PATCH:
-            self.process_patch_msg(msg)
-        elif msg_type == self.UPDATE_TYPE_CHECKSUM:
-            self.process_checksum_msg(msg)
-        elif msg_type == self.DELETE_FILE_MSG:
-            self.process_delete_msg(msg)
-        elif msg_type == self.MANIFEST_MSG:
-            self.process_manifest_msg(msg)
+        self.set_state(session, entry[0](session, msg))
+
+        if session.state == self.IDLE and self.sessions.get(sid) is session:
+            # The offer was not for us
+            del self.sessions[sid]
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# A/B application slots.
+#
+# The application runs either from the legacy /flash root or from one of two
+# slot directories. Updates are built in the slot that is not running and
+# activated by writing a single pointer record, so activation and rollback
+# never touch the application files themselves.
+#
+# The pointer is stored as two alternating records
+# (seq,active,previous,state,crc). The valid record with the highest sequence
+# number wins, so a power cut while writing one record leaves the other one in
+# place. A newly activated slot is on trial until the application confirms it;
+# a watchdog reset while on trial rolls back to the previous slot.
+
+import ubinascii
+import machine
+import sys
+import uos
+
+FLASH_ROOT = '/flash'
+ROOT_SLOT = 'root'
+SLOT_A = 'a'
+SLOT_B = 'b'
+
+TRIAL = 'T'
+CONFIRMED = 'C'
+
+POINTER_FILES = ('/flash/active_slot.0', '/flash/active_slot.1')
+
+# Modules boot.py imports from /flash before the slot is chosen. They stay
+# in sys.modules, so a copy in a slot would never run.
+ROOT_MODULES = ('boot.py', 'slots.py', 'journal.py')
+
+# Entries of /flash that never belong to an application tree
+RESERVED = ('slot_a', 'slot_b', 'ota_stage', 'ota_journal', 'active_slot.0', 'active_slot.1',
+            'index_a', 'index_b', 'inventory_a', 'inventory_b',
+            'hash_cache', 'sys') + ROOT_MODULES
+
+COPY_CHUNK = 512
+
+# Hardware watchdog armed at boot while the active slot is on trial
+TRIAL_WDT_TIMEOUT_MS = 60000
+
+
+def slot_path(slot):
+    if slot == ROOT_SLOT:
+        return FLASH_ROOT
+    return '{}/slot_{}'.format(FLASH_ROOT, slot)
+
+
+def _record_crc(body):
+    return ubinascii.crc32(body.encode()) & 0xffffffff
+
+
+def _read_record(path):
+    try:
+        with open(path, 'r') as fh:
+            body, crc = fh.read().rsplit(',', 1)
+        if int(crc) != _record_crc(body):
+            return None
+        fields = body.split(',')
+        if len(fields) == 3:
+            fields.append(CONFIRMED)
+        seq, active, previous, state = fields
+        return (int(seq), active, previous or None, state)
+    except Exception:
+        return None
+
+
+def _read_pointer():
+    best = None
+    best_idx = 0
+    for idx, path in enumerate(POINTER_FILES):
+        record = _read_record(path)
+        if record is not None and (best is None or record[0] > best[0]):
+            best = record
+            best_idx = idx
+    return best, best_idx
+
+
+def read_pointer():
+    record, _ = _read_pointer()
+    if record is None:
+        return (ROOT_SLOT, None)
+    return (record[1], record[2])
+
+
+def is_confirmed():
+    record, _ = _read_pointer()
+    return record is None or record[3] == CONFIRMED
+
+
+def _write_pointer(active, previous, state=CONFIRMED):
+    record, idx = _read_pointer()
+    seq = 0 if record is None else record[0] + 1
+    # Always overwrite the record that is not the current one
+    path = POINTER_FILES[1 - idx] if record is not None else POINTER_FILES[0]
+
+    body = '{},{},{},{}'.format(seq, active, previous or '', state)
+    with open(path, 'w') as fh:
+        fh.write('{},{}'.format(body, _record_crc(body)))
+
+
+def active_slot():
+    return read_pointer()[0]
+
+
+def active_path():
+    return slot_path(active_slot())
+
+
+def inactive_slot():
+    return SLOT_B if active_slot() == SLOT_A else SLOT_A
+
+
+def invalidate_previous():
+    # The previous slot is about to be overwritten, it is no longer a rollback target
+    active, previous = read_pointer()
+    if previous is not None:
+        _write_pointer(active, None)
+
+
+def activate(slot):
+    active, _ = read_pointer()
+    _write_pointer(slot, active, TRIAL)
+
+
+def confirm(slot):
+    # Called once the application runs correctly from slot. A firmware that
+    # has just activated an update is still running from the previous slot
+    # and must not confirm the new one, so only the active slot is confirmed
+    # and only while it is on trial.
+    record, _ = _read_pointer()
+    if record is None or record[1] != slot or record[3] != TRIAL:
+        return
+    _write_pointer(slot, record[2])
+
+
+def rollback():
+    active, previous = read_pointer()
+    if previous is None:
+        return False
+    _write_pointer(previous, None)
+    return True
+
+
+def index_path(slot):
+    return '{}/index_{}'.format(FLASH_ROOT, slot)
+
+
+def read_index(slot):
+    # Returns the relative paths of the files in the slot, or None if unknown.
+    # Files can be uploaded to the /flash root by hand, so it is always scanned.
+    if slot == ROOT_SLOT:
+        return list(walk(FLASH_ROOT))
+
+    try:
+        with open(index_path(slot), 'r') as fh:
+            lines = fh.read().split('\n')
+    except OSError:
+        return None
+
+    # The last line holds the number of entries, a truncated index is unusable
+    files = lines[:-1]
+    try:
+        if int(lines[-1][1:]) != len(files):
+            return None
+    except ValueError:
+        return None
+    return files
+
+
+def write_index(slot, files):
+    with open(index_path(slot), 'w') as fh:
+        for path in files:
+            fh.write(path + '\n')
+        fh.write('#{}'.format(len(files)))
+
+
+def clear_slot(slot):
+    # Removes the files listed in the slot index, the slot is only scanned
+    # when its index is missing or damaged
+    files = read_index(slot)
+    if files is None:
+        remove_tree(slot_path(slot))
+    else:
+        root = slot_path(slot)
+        for path in files:
+            try:
+                uos.remove(root + '/' + path)
+            except OSError:
+                pass  # File was never written
+
+    try:
+        uos.remove(index_path(slot))
+    except OSError:
+        pass  # There is no index
+
+
+def is_dir(path):
+    try:
+        return uos.stat(path)[0] & 0x4000 != 0
+    except OSError:
+        return False
+
+
+def makedirs(path):
+    current = ''
+    for part in path.split('/'):
+        if not part:
+            continue
+        current += '/' + part
+        try:
+            uos.mkdir(current)
+        except OSError:
+            pass  # Directory already exists
+
+
+def remove_tree(path):
+    if not is_dir(path):
+        try:
+            uos.remove(path)
+        except OSError:
+            pass  # Nothing to remove
+        return
+
+    for name in uos.listdir(path):
+        remove_tree(path + '/' + name)
+    uos.rmdir(path)
+
+
+def walk(root, prefix=''):
+    # Yields the paths of all files below root, relative to root
+    base = root + '/' + prefix if prefix else root
+    for name in uos.listdir(base):
+        if not prefix and root == FLASH_ROOT and name in RESERVED:
+            continue
+        rel = prefix + '/' + name if prefix else name
+        if is_dir(root + '/' + rel):
+            for child in walk(root, rel):
+                yield child
+        else:
+            yield rel
+
+
+def copy_file(src, dst):
+    # Returns the CRC32 of the copied content
+    crc = 0
+    idx = dst.rfind('/')
+    if idx > 0:
+        makedirs(dst[:idx])
+
+    buf = bytearray(COPY_CHUNK)
+    mv = memoryview(buf)
+    with open(src, 'rb') as fin:
+        with open(dst, 'wb') as fout:
+            while True:
+                n = fin.readinto(buf)
+                if not n:
+                    break
+                fout.write(mv[:n])
+                crc = ubinascii.crc32(mv[:n], crc)
+    return crc & 0xffffffff
+
+
+def boot():
+    if machine.reset_cause() == machine.WDT_RESET and not is_confirmed():
+        print("Watchdog reset on an unconfirmed slot: rolling back")
+        rollback()
+
+    if not is_confirmed():
+        # The application feeds the watchdog once it has started its own.
+        # A slot that raises or hangs before that is reset by it and rolled
+        # back on the next boot.
+        machine.WDT(timeout = TRIAL_WDT_TIMEOUT_MS)
+
+    path = active_path()
+    if path == FLASH_ROOT:
+        return
+
+    print("Booting from slot: {}".format(path))
+    uos.chdir(path)
+    sys.path[:] = ['', path + '/lib', FLASH_ROOT + '/lib']
+    machine.main(path + '/main.py')
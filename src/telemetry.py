@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Batched binary telemetry.
+#
+# Samples are stored as fixed point int16 values (hundredths) and packed as
+#
+#   version (1 byte), sample count (1 byte),
+#   first temperature (int16 BE), first humidity (int16 BE),
+#   then per sample the zigzag varint deltas of temperature and humidity
+#
+# so a batch of slowly changing readings costs about 2 bytes per sample.
+
+import ustruct
+
+FORMAT_VERSION = 1
+SCALE = 100
+HEADER_SIZE = 6
+MAX_SAMPLES = 255
+
+
+def to_fixed(value):
+    fixed = int(round(value * SCALE))
+    return max(min(fixed, 32767), -32768)
+
+
+def varint_size(value):
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def write_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+class TelemetryBuffer:
+
+    def __init__(self, max_payload):
+        self.max_payload = max_payload
+        self.samples = []
+        self.size = HEADER_SIZE
+
+    def clear(self):
+        self.samples = []
+        self.size = HEADER_SIZE
+
+    def _sample_size(self, sample):
+        if not self.samples:
+            return 0
+        last = self.samples[-1]
+        return varint_size(zigzag(sample[0] - last[0])) + varint_size(zigzag(sample[1] - last[1]))
+
+    def add(self, temperature, humidity):
+        # Returns a packed batch when the new sample does not fit in the
+        # current one, the sample then starts the next batch
+        sample = (to_fixed(temperature), to_fixed(humidity))
+        batch = None
+        if len(self.samples) >= MAX_SAMPLES or \
+           self.size + self._sample_size(sample) > self.max_payload:
+            batch = self.pack()
+            self.clear()
+
+        self.size += self._sample_size(sample)
+        self.samples.append(sample)
+        return batch
+
+    def pack(self):
+        if not self.samples:
+            return None
+
+        first = self.samples[0]
+        buf = bytearray(ustruct.pack('>BBhh', FORMAT_VERSION, len(self.samples), first[0], first[1]))
+        last = first
+        for sample in self.samples[1:]:
+            write_varint(buf, zigzag(sample[0] - last[0]))
+            write_varint(buf, zigzag(sample[1] - last[1]))
+            last = sample
+        return buf
@@ -1,4 +1,5 @@
 import crypto
+import uhashlib
 
 def compare_versions(version1, version2):
     v1 = [int(x) for x in version1.split(".")]
@@ -21,3 +22,9 @@ def random():
 
 def random_range(rfrom, rto):
    return random()*(rto-rfrom)+rfrom
+
+def eui_jitter(dev_eui, window, salt = ''):
+   # Delay in [0, window) that is fixed for a device, so a fleet spreads out
+   # its uplinks instead of sending them at the same instant
+   h = uhashlib.sha1((dev_eui + salt).encode()).digest()
+   return ((h[0]<<24)+(h[1]<<16)+(h[2]<<8)+h[3])*window/4294967296.0
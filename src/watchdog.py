@@ -1,35 +1,149 @@
 #!/usr/bin/env python
 
 from machine import Timer
+from machine import WDT
+import micropython
+import utime
 import _thread
 
 class Watchdog:
 
-    def __init__(self):
+    # The deadline follows the observed gap between acks (mean and mean
+    # deviation, as TCP does for its retransmission timeout) once enough
+    # gaps have been measured, bounded by these limits in seconds.
+    MIN_TIMEOUT = 15
+    MAX_TIMEOUT = 900
+    MIN_SAMPLES = 4
+
+    CHECK_PERIOD = 5
+
+    def __init__(self, on_timeout):
         self.failed = False
-        self.acknowledged = 0
         self._alarm = None
+        self._on_timeout = on_timeout
         self._lock = _thread.allocate_lock()
 
+        self.timeout = 120
+        self.samples = 0
+        self.mean_gap = 0  # ms
+        self.dev_gap = 0  # ms
+        self.max_gap = 0  # ms
+        self.last_ack = utime.ticks_ms()
+
     def enable(self, timeout = 120):
+        self.cancel()
+
+        with self._lock:
+            self.failed = False
+            self.timeout = timeout
+            self.last_ack = utime.ticks_ms()
+        self._alarm = Timer.Alarm(self._check, s = self.CHECK_PERIOD, periodic = True)
+
+    def cancel(self):
         if self._alarm:
             self._alarm.cancel()
             self._alarm = None
-            
-        self._alarm = Timer.Alarm(self._check, s = timeout, periodic = True)
+
+    def reset_stats(self):
+        with self._lock:
+            self.samples = 0
+            self.mean_gap = 0
+            self.dev_gap = 0
+            self.max_gap = 0
+
+    def deadline(self):
+        # Seconds without an ack before the timeout handler runs
+        if self.samples < self.MIN_SAMPLES:
+            return self.timeout
+        deadline = (2 * self.mean_gap + 4 * self.dev_gap) // 1000
+        return min(max(deadline, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "samples": self.samples,
+                "mean_gap_ms": self.mean_gap,
+                "dev_gap_ms": self.dev_gap,
+                "max_gap_ms": self.max_gap,
+                "deadline_s": self.deadline(),
+            }
 
     def _check(self, alarm):
         with self._lock:
-            if self.acknowledged > 0:
-                self.failed = False
-                self.acknowledged = 0
-            else:
-                self.failed = True
+            idle = utime.ticks_diff(utime.ticks_ms(), self.last_ack)
+            if idle < self.deadline() * 1000:
+                return
+            self.failed = True
+
+        # The timeout handler runs outside of the alarm context
+        try:
+            micropython.schedule(self._expired, None)
+        except RuntimeError:
+            return  # Schedule queue is full, retry on the next period
+        self.cancel()
+
+    def _expired(self, arg):
+        self._on_timeout()
 
     def ack(self):
+        now = utime.ticks_ms()
         with self._lock:
-            self.acknowledged += 1
+            gap = utime.ticks_diff(now, self.last_ack)
+            self.last_ack = now
 
-    def update_failed(self):
+            if self.samples == 0:
+                self.mean_gap = gap
+                self.dev_gap = gap // 2
+            else:
+                err = gap - self.mean_gap
+                self.mean_gap += err >> 3
+                self.dev_gap += (abs(err) - self.dev_gap) >> 2
+            self.samples += 1
+            self.max_gap = max(self.max_gap, gap)
+
+
+class HardwareWatchdog:
+
+    # Feeds machine.WDT only while every registered subsystem keeps beating.
+    # A stalled subsystem stops the feeding and the hardware watchdog resets
+    # the device, an unconfirmed update is then rolled back at boot.
+    # Pass any object with a feed() method as wdt to run it off the device.
+
+    def __init__(self, timeout_ms, wdt = None):
+        self._wdt = wdt if wdt is not None else WDT(timeout = timeout_ms)
+        self._lock = _thread.allocate_lock()
+        self._beats = dict()  # name -> [last beat ticks, max stall ms]
+        self.stalled = None
+
+    def register(self, name, max_stall_ms):
+        with self._lock:
+            self._beats[name] = [utime.ticks_ms(), max_stall_ms]
+
+    def unregister(self, name):
+        with self._lock:
+            self._beats.pop(name, None)
+
+    def beat(self, name):
         with self._lock:
-            return self.failed
+            if name in self._beats:
+                self._beats[name][0] = utime.ticks_ms()
+
+    def find_stalled(self):
+        now = utime.ticks_ms()
+        with self._lock:
+            for name, beat in self._beats.items():
+                if utime.ticks_diff(now, beat[0]) > beat[1]:
+                    return name
+        return None
+
+    def feed(self):
+        stalled = self.find_stalled()
+        if stalled is not None:
+            if stalled != self.stalled:
+                print("Watchdog: {} stalled, no longer feeding".format(stalled))
+            self.stalled = stalled
+            return False
+
+        self.stalled = None
+        self._wdt.feed()
+        return True
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Host benchmark of the hash cache over a tree of generated modules:
+#
+#   python tests/bench_hashcache.py [files]
+#
+# Compares hashing every file with a cold cache, a warm cache loaded from
+# its file, and a warm cache after one file changed.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import host  # noqa: F401, sets up the import path
+import inventory
+import slots
+from hashcache import HashCache
+
+
+def make_tree(root, count, seed = 0):
+    rng = random.Random(seed)
+    files = []
+    for idx in range(count):
+        path = 'lib/pkg{}/mod{}.py'.format(idx % 10, idx)
+        slots.makedirs(root + '/' + path[:path.rfind('/')])
+        with open(root + '/' + path, 'w') as fh:
+            fh.write('x = {}\n'.format(idx) * rng.randint(50, 1000))
+        files.append(path)
+    return files
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print('{:28s} {:8.1f} ms'.format(label, (time.perf_counter() - start) * 1000))
+    return result
+
+
+def hash_all(cache, root, files):
+    for path in files:
+        cache.get(root + '/' + path)
+    cache.save()
+    return cache.hits, cache.misses
+
+
+def main(count):
+    root = tempfile.mkdtemp()
+    try:
+        files = make_tree(root, count)
+        size = sum(os.stat(root + '/' + path)[6] for path in files)
+        cache_file = root + '/hash_cache'
+        print('{} files, {} KiB'.format(count, size // 1024))
+
+        timed('hash every file', lambda: [inventory.file_hash(root + '/' + path) for path in files])
+
+        cache = HashCache(cache_file)
+        print('  hits {}, misses {}'.format(*timed('cold cache', lambda: hash_all(cache, root, files))))
+
+        cache = timed('load cache', lambda: HashCache(cache_file))
+        print('  hits {}, misses {}'.format(*timed('warm cache', lambda: hash_all(cache, root, files))))
+
+        # Appending changes the size, the mtime may still be the same second
+        changed = root + '/' + files[count // 2]
+        with open(changed, 'a') as fh:
+            fh.write('y = 1\n')
+        cache = HashCache(cache_file)
+        print('  hits {}, misses {}'.format(*timed('warm cache, one changed', lambda: hash_all(cache, root, files))))
+
+        print('cache file {} bytes'.format(os.stat(cache_file)[6]))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# Host benchmark of the heap held by a parsed update patch:
+#
+#   python tests/bench_patch_memory.py [edits]
+#
+# Parses and applies a patch of src/ota.py made by the server's
+# diff-match-patch, once with patch_fromText + patch_apply and once with
+# patch_fromTextCompact + patch_applyInPlace as dry_run() does. The memory
+# and allocated blocks are measured while the parsed patches are alive, and
+# the peak while they are applied.
+
+import gc
+import random
+import sys
+import time
+import tracemalloc
+
+import host
+import diff_match_patch as dmp_module
+
+
+def edited(text, count, seed = 0):
+    # A release of the same file: lines changed, added and removed
+    rng = random.Random(seed)
+    lines = text.split('\n')
+    for _ in range(count):
+        idx = rng.randrange(len(lines))
+        kind = rng.randrange(3)
+        if kind == 0:
+            lines[idx] = lines[idx].replace('session', 'sess')
+            lines[idx] += '  # changed'
+        elif kind == 1:
+            lines.insert(idx, '    # added {}'.format(rng.getrandbits(32)))
+        else:
+            del lines[idx]
+    return '\n'.join(lines)
+
+
+def blocks():
+    return sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+
+
+def measure(label, parse, apply, patch_text, base, expected):
+    gc.collect()
+    tracemalloc.start()
+    start_blocks = blocks()
+    start = time.perf_counter()
+
+    patches = parse(patch_text)
+    alive, _ = tracemalloc.get_traced_memory()
+    alive_blocks = blocks() - start_blocks
+    text, results = apply(patches, base)
+    _, peak = tracemalloc.get_traced_memory()
+
+    elapsed = (time.perf_counter() - start) * 1000
+    patches = None
+    tracemalloc.stop()
+    assert text == expected and False not in results
+    print('{:44s} {:8d} {:8d} {:8d} {:8.1f}'.format(label, alive // 1024, alive_blocks, peak // 1024, elapsed))
+
+
+def main(count):
+    upstream = host.upstream_dmp()
+    if upstream is None:
+        print('The diff-match-patch package is needed to make the patch')
+        return
+
+    with open(host.SRC_DIR + '/ota.py') as fh:
+        base = fh.read()
+    new = edited(base, count)
+    patch_text = upstream.patch_toText(upstream.patch_make(base, new))
+    print('{} bytes, patch of {} bytes, {} hunks'.format(
+        len(base), len(patch_text), patch_text.count('@@ -')))
+
+    dmp = dmp_module.diff_match_patch()
+    print('{:44s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('', 'KiB', 'blocks', 'peak KiB', 'ms'))
+    measure('patch_fromText + patch_apply',
+            dmp.patch_fromText, dmp.patch_apply, patch_text, base, new)
+    measure('patch_fromTextCompact + patch_applyInPlace',
+            dmp.patch_fromTextCompact, dmp.patch_applyInPlace, patch_text, base, new)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 60)
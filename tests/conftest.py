@@ -0,0 +1 @@
+import host  # noqa: F401, sets up the import path
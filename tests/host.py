@@ -0,0 +1,70 @@
+# Runs the device modules on the host. The MicroPython modules they import
+# are replaced by the thin wrappers in stubs/, and the /flash paths of
+# slots, journal and inventory can be moved to a scratch directory.
+
+import importlib.util
+import os
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), 'src')
+
+for path in (SRC_DIR, os.path.join(TESTS_DIR, 'stubs')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def use_flash_root(root):
+    # Points every file of the device modules at root instead of /flash
+    import slots
+    import journal
+    import hashcache
+    import ota
+
+    slots.FLASH_ROOT = root
+    slots.POINTER_FILES = (root + '/active_slot.0', root + '/active_slot.1')
+    journal.JOURNAL_FILE = root + '/ota_journal'
+    hashcache.CACHE_FILE = root + '/hash_cache'
+    ota.LoraOTA.STAGING_DIR = root + '/ota_stage'
+
+
+def file_frames(name, patch, sid = 0, pre = '', post = ''):
+    # Frames the server sends for one patched file: the filename, the
+    # compressed patch in fragments and its checksum
+    import hashlib
+    import zlib
+
+    def header(msg_type):
+        if sid:
+            return '$OTA,{}:{},'.format(msg_type, sid).encode()
+        return '$OTA,{},'.format(msg_type).encode()
+
+    data = patch.encode()
+    compressed = zlib.compress(data)
+    fields = [name] + ([pre, post] if pre or post else [])
+    frames = [header(5) + ','.join(fields).encode() + b',*']
+    for start in range(0, len(compressed), 50):
+        frames.append(header(6) + compressed[start:start + 50] + b',*')
+    frames.append(header(7) + hashlib.sha1(data).hexdigest().encode() + b',*')
+    return frames
+
+
+def upstream_dmp():
+    # The upstream diff-match-patch package, which the server uses to make
+    # the patches. It has the name of the trimmed copy in src/, so it is
+    # loaded from its files. Returns None if it is not installed.
+    try:
+        from importlib import metadata
+        init = metadata.distribution('diff-match-patch').locate_file('diff_match_patch/__init__.py')
+    except Exception:
+        return None
+    init = str(init)
+    if not os.path.exists(init):
+        return None
+
+    spec = importlib.util.spec_from_file_location('upstream_dmp', init,
+                                                  submodule_search_locations=[os.path.dirname(init)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['upstream_dmp'] = module
+    spec.loader.exec_module(module)
+    return module.diff_match_patch()
@@ -0,0 +1,7 @@
+# Host stand-in for the Pycom crypto module
+
+import os
+
+
+def getrandbits(bits):
+    return os.urandom((bits + 7) // 8)
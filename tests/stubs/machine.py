@@ -0,0 +1,60 @@
+# Host stand-in for the Pycom machine module
+
+WDT_RESET = 3
+
+
+class ResetError(BaseException):
+
+    # machine.reset() does not return on the device, nothing may catch it
+
+    pass
+
+
+def reset_cause():
+    return 0
+
+
+def reset():
+    raise ResetError()
+
+
+def main(path):
+    pass
+
+
+class RTC:
+
+    def init(self, datetime):
+        pass
+
+
+class Timer:
+
+    class Alarm:
+
+        # Never fires by itself, a test calls fire() instead
+
+        def __init__(self, handler, s = 0, ms = 0, us = 0, arg = None, periodic = False):
+            self.handler = handler
+            self.periodic = periodic
+            self.cancelled = False
+
+        def fire(self):
+            self.handler(self)
+
+        def cancel(self):
+            self.cancelled = True
+
+
+class WDT:
+
+    # Every watchdog armed, the latest last
+    armed = []
+
+    def __init__(self, id = 0, timeout = 0):
+        self.timeout = timeout
+        self.feeds = 0
+        WDT.armed.append(self)
+
+    def feed(self):
+        self.feeds += 1
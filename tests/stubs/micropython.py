@@ -0,0 +1,5 @@
+# Host stand-in for the micropython module, scheduled calls run at once
+
+
+def schedule(func, arg):
+    func(arg)
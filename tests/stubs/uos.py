@@ -0,0 +1 @@
+from os import *
@@ -0,0 +1,33 @@
+# Host stand-in for the LoRa socket of usocket. Uplinks are kept in sent,
+# the radio stand-in in network.py puts downlinks in inbox.
+
+AF_LORA = 160
+SOCK_RAW = 3
+SOL_LORA = 0x10000
+SO_DR = 0x10
+
+# Latest socket created
+last = None
+
+
+class socket:
+
+    def __init__(self, family, kind):
+        global last
+        self.sent = []
+        self.inbox = []
+        last = self
+
+    def setsockopt(self, level, option, value):
+        pass
+
+    def setblocking(self, flag):
+        pass
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+    def recvfrom(self, bufsize):
+        if not self.inbox:
+            return b'', 1
+        return self.inbox.pop(0), 1
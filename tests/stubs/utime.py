@@ -0,0 +1,20 @@
+# Host stand-in for the MicroPython utime module
+
+from time import *  # noqa: F401, F403
+import time as _time
+
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000)
+
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+
+def ticks_diff(ticks1, ticks2):
+    return ticks1 - ticks2
+
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
@@ -0,0 +1,7 @@
+# Host stand-in for the MicroPython uzlib module
+
+import zlib
+
+
+def decompress(data, *args):
+    return zlib.decompress(data)
@@ -0,0 +1,268 @@
+import asyncio
+import os
+
+import pytest
+
+import host
+import journal
+import machine
+import slots
+import uos
+from loranet import LoraNet
+from network import LoRa
+from ota import LoraOTA
+
+OLD_FILES = {'main.py': 'print("v1")\n', 'lib/util.py': 'X = 1\n', 'cfg.py': 'A = 1\n'}
+NEW_FILES = {'main.py': 'print("v2")\n', 'lib/util.py': 'X = 1\n', 'lib/new.py': 'A = 2\n'}
+
+# The update as the server sends it: main.py patched, lib/new.py created,
+# cfg.py deleted and lib/util.py copied
+FRAMES = ([b'$OTA,1,1.0.1,1700000000,*',
+           b'$OTA,3,01020304,00112233445566778899aabbccddeeff,00112233445566778899aabbccddeeff,*'] +
+          host.file_frames('main.py', '@@ -5,8 +5,8 @@\n t(%22v\n-1\n+2\n %22)%0A\n') +
+          host.file_frames('lib/new.py', '@@ -0,0 +1,6 @@\n+A = 2%0A\n') +
+          [b'$OTA,8,cfg.py,*',
+           b'$OTA,9,{"update": 1, "new": 1, "delete": 1},*'])
+
+# Writes to flash during the apply; the device loses power right after one
+FAULTS = [(slots, 'invalidate_previous'), (slots, 'clear_slot'), (slots, 'write_index'),
+          (slots, 'copy_file'), (slots, 'activate'), (journal, 'begin'),
+          (journal, 'record_file'), (journal, 'commit'), (journal, 'clear'),
+          (uos, 'remove')]
+
+
+class Crash(BaseException):
+    # A power loss, the except clauses of the OTA code do not catch it
+    pass
+
+
+def write(path, text):
+    slots.makedirs(path[:path.rfind('/')])
+    with open(path, 'w') as fh:
+        fh.write(text)
+
+
+def read_tree(root):
+    files = dict()
+    for path in slots.walk(root):
+        with open(root + '/' + path) as fh:
+            files[path] = fh.read()
+    return files
+
+
+def make_flash(root, running):
+    # A device running from the /flash root, or from slot a after an update
+    os.makedirs(root, exist_ok=True)
+    host.use_flash_root(root)
+    for path, text in OLD_FILES.items():
+        write(slots.slot_path(running) + '/' + path, text)
+    if running != slots.ROOT_SLOT:
+        slots.activate(running)
+        slots.confirm(running)
+
+    # Left behind in the other slot by an earlier build
+    target = slots.inactive_slot()
+    write(slots.slot_path(target) + '/stale.py', 'S = 1\n')
+    slots.write_index(target, ['stale.py'])
+    return root
+
+
+@pytest.fixture(params=[slots.ROOT_SLOT, slots.SLOT_A])
+def running(request):
+    return request.param
+
+
+@pytest.fixture
+def flash(running, tmp_path):
+    return make_flash(str(tmp_path), running)
+
+
+def apply_update(monkeypatch, crash_at = None):
+    # Receives the update and runs LoraOTA.apply_update(). Returns the
+    # faults reached, the device loses power after fault crash_at, an
+    # index into them or the name of the first one to crash at.
+    ota = LoraOTA(LoraNet(868100000, 5, LoRa.EU868), '1.0.0')
+    for frame in FRAMES:
+        ota.process_message(frame)
+    session = ota.sessions[0]
+    assert session.apply_pending
+
+    calls = []
+
+    def inject(module, name):
+        func = getattr(module, name)
+        label = '{}.{}'.format(module.__name__, name)
+
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            calls.append(label)
+            if crash_at == len(calls) - 1 or crash_at == label:
+                raise Crash(label)
+            return result
+        patch.setattr(module, name, wrapper)
+
+    with monkeypatch.context() as patch:
+        for module, name in FAULTS:
+            inject(module, name)
+        try:
+            asyncio.run(ota.apply_update(session))
+        except machine.ResetError:
+            # Completed, restarting into the new slot
+            assert crash_at is None
+    return calls
+
+
+def reboot():
+    # What boot.py does before running the application
+    journal.recover()
+    return slots.read_pointer()
+
+
+def test_crash_at_every_fault(running, tmp_path, monkeypatch):
+    make_flash(str(tmp_path / 'count'), running)
+    faults = apply_update(monkeypatch)
+    # Every copy is recorded in the journal right after it is written
+    assert faults.index('slots.copy_file') + 1 == faults.index('journal.record_file')
+    assert 'journal.commit' in faults
+
+    for crash_at in range(len(faults)):
+        make_flash(str(tmp_path / str(crash_at)), running)
+        old = slots.active_slot()
+        _, old_previous = slots.read_pointer()
+        target = slots.inactive_slot()
+        with pytest.raises(Crash):
+            apply_update(monkeypatch, crash_at)
+
+        active, previous = reboot()
+        reached = faults[:crash_at + 1]
+        assert not os.path.exists(journal.JOURNAL_FILE), reached
+        if 'journal.commit' not in reached:
+            # Rolled back, the slot being built may no longer be a rollback target
+            assert active == old, reached
+            assert previous in (old_previous, None), reached
+            assert read_tree(slots.slot_path(old)) == OLD_FILES, reached
+        else:
+            # Rolled forward, the new slot is on trial until confirmed
+            assert (active, previous) == (target, old), reached
+            assert not slots.is_confirmed(), reached
+            assert read_tree(slots.slot_path(target)) == NEW_FILES, reached
+
+        # A second boot changes nothing
+        assert reboot() == (active, previous), reached
+
+        if active == old:
+            # The update is received again and the build cleans up what the
+            # interrupted one left behind
+            slots.remove_tree(LoraOTA.STAGING_DIR)
+            apply_update(monkeypatch)
+            assert slots.read_pointer() == (target, old), reached
+            assert read_tree(slots.slot_path(target)) == NEW_FILES, reached
+
+
+def test_torn_journal(flash, monkeypatch):
+    # The last record may be cut anywhere by a power loss, the update is
+    # only rolled forward when the commit record is complete
+    old = slots.active_slot()
+    target = slots.inactive_slot()
+    with pytest.raises(Crash):
+        apply_update(monkeypatch, 'journal.commit')
+    with open(journal.JOURNAL_FILE, 'rb') as fh:
+        data = fh.read()
+    pointers = dict()
+    for path in slots.POINTER_FILES:
+        if os.path.exists(path):
+            with open(path, 'rb') as fh:
+                pointers[path] = fh.read()
+
+    # Only the newline of the commit record may be missing
+    assert data.endswith(b'\n')
+    committed = len(data) - 1
+
+    for length in range(len(data) + 1):
+        for path in slots.POINTER_FILES:
+            if os.path.exists(path):
+                os.remove(path)
+        for path, record in pointers.items():
+            with open(path, 'wb') as fh:
+                fh.write(record)
+        with open(journal.JOURNAL_FILE, 'wb') as fh:
+            fh.write(data[:length])
+
+        active, _ = reboot()
+        assert active == (target if length >= committed else old), length
+        assert not os.path.exists(journal.JOURNAL_FILE)
+
+
+def test_torn_index(running, tmp_path, monkeypatch):
+    # An index cut by a power loss is not trusted, the next build scans the
+    # slot to clean it up
+    length = 0
+    while True:
+        make_flash(str(tmp_path / str(length)), running)
+        old = slots.active_slot()
+        target = slots.inactive_slot()
+        with pytest.raises(Crash):
+            apply_update(monkeypatch, 'journal.record_file')
+        with open(slots.index_path(target), 'rb') as fh:
+            data = fh.read()
+        if length == len(data):
+            break
+        with open(slots.index_path(target), 'wb') as fh:
+            fh.write(data[:length])
+        write(slots.slot_path(target) + '/stale.py', 'S = 1\n')
+        assert slots.read_index(target) is None
+
+        assert reboot() == (old, None)
+        slots.remove_tree(LoraOTA.STAGING_DIR)
+        apply_update(monkeypatch)
+        assert read_tree(slots.slot_path(target)) == NEW_FILES, length
+        length += 1
+
+
+def test_corrupted_file_is_not_activated(flash, monkeypatch):
+    old = slots.active_slot()
+    target = slots.inactive_slot()
+    with pytest.raises(Crash):
+        apply_update(monkeypatch, 'journal.commit')
+    write(slots.slot_path(target) + '/lib/new.py', 'A = 3\n')
+
+    assert reboot() == (old, None)
+
+
+def test_only_the_running_slot_is_confirmed(flash, monkeypatch):
+    # The old firmware keeps running until its jittered restart, it must not
+    # confirm the slot it has just activated
+    old = slots.active_slot()
+    apply_update(monkeypatch)
+    target = slots.active_slot()
+    assert target != old
+
+    slots.confirm(old)
+    assert not slots.is_confirmed()
+    slots.confirm(target)
+    assert slots.is_confirmed()
+
+
+def test_trial_boot_arms_the_watchdog(flash, monkeypatch):
+    # A slot on trial that dies before starting its own watchdog is reset by
+    # the one armed at boot, and rolled back on the next boot
+    old = slots.active_slot()
+    apply_update(monkeypatch)
+    target = slots.active_slot()
+
+    class Sys:
+        path = []
+
+    monkeypatch.setattr(slots, 'sys', Sys)
+    monkeypatch.setattr(slots.uos, 'chdir', lambda path: None)
+    monkeypatch.setattr(machine, 'main', lambda path: None)
+    monkeypatch.setattr(machine.WDT, 'armed', [])
+
+    slots.boot()
+    assert slots.active_slot() == target
+    assert [wdt.timeout for wdt in machine.WDT.armed] == [slots.TRIAL_WDT_TIMEOUT_MS]
+
+    monkeypatch.setattr(machine, 'reset_cause', lambda: machine.WDT_RESET)
+    slots.boot()
+    assert slots.read_pointer() == (old, None)
+    assert len(machine.WDT.armed) == 1
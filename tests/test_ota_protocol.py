@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+import host
+import airtime
+import machine
+import slots
+import usocket
+from loranet import LoraNet
+from network import LoRa
+from ota import LoraOTA
+
+AUTH = ('70b3d5499a000001', '0000000000000000', '00112233445566778899aabbccddeeff')
+KEYS = '$OTA,3,{},00112233445566778899aabbccddeeff,00112233445566778899aabbccddeeff,*'
+
+OLD_MAIN = 'print("hello")\nx = 1\n'
+NEW_MAIN = 'print("hello")\nx = 2\n'
+PATCH = '@@ -1,21 +1,21 @@\n print(%22hello%22)%0Ax = \n-1\n+2\n %0A\n'
+
+
+@pytest.fixture
+def flash(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    host.use_flash_root(root)
+    for path, text in (('main.py', OLD_MAIN), ('cfg.py', 'A = 1\n')):
+        with open(root + '/' + path, 'w') as fh:
+            fh.write(text)
+
+    # No duty cycle or settle time, the uplinks go out at once
+    monkeypatch.setattr(airtime, 'off_time', lambda toa, frequency: 0)
+    monkeypatch.setattr(LoraNet, 'JOIN_SETTLE_S', 0)
+    monkeypatch.setattr(LoraOTA, 'JOIN_POLL_S', 0)
+    return root
+
+
+def read(path):
+    with open(path) as fh:
+        return fh.read()
+
+
+def uplinks():
+    return [frame.split(b',')[1] for frame in usocket.last.sent]
+
+
+async def settle():
+    # A few passes of the event loop, much less than the idle wait of the
+    # workers, so they only get a frame if the radio callback woke them
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+async def start(lora, ota):
+    lora.connect()
+    tasks = (asyncio.ensure_future(lora.run()), asyncio.ensure_future(ota.run()))
+    while not lora.joined():
+        await asyncio.sleep(0.01)
+    await settle()
+    return tasks
+
+
+async def deliver(lora, frames):
+    for frame in frames:
+        if isinstance(frame, str):
+            frame = frame.encode()
+        lora.lora.receive(frame)
+        await settle()
+
+
+def test_update_through_the_radio(flash):
+    async def scenario():
+        lora = LoraNet(868100000, 5, LoRa.EU868, auth=AUTH)
+        ota = LoraOTA(lora, '1.0.0')
+        radio_task, ota_task = await start(lora, ota)
+
+        await deliver(lora, ['$OTA,1,1.0.1,1700000000,*'])
+        assert ota.sessions[0].state == ota.OFFERED
+
+        # A malformed frame only loses itself, the worker goes on
+        await deliver(lora, [KEYS.format('zz')])
+        assert not ota_task.done()
+
+        await deliver(lora, [KEYS.format('01020304')])
+        assert ota.sessions[0].state == ota.KEYED
+        assert lora.lora.multicast == [0x01020304]
+
+        await deliver(lora, host.file_frames('main.py', PATCH))
+        await deliver(lora, ['$OTA,8,cfg.py,*'])
+        await deliver(lora, ['$OTA,9,{"update": 1, "new": 0, "delete": 1},*'])
+
+        with pytest.raises(machine.ResetError):
+            await asyncio.wait_for(ota_task, 5)
+        while lora.pending():
+            await asyncio.sleep(0.01)
+        lora.stop()
+        await asyncio.wait_for(radio_task, 10)
+        return ota
+
+    asyncio.run(scenario())
+
+    assert slots.read_pointer() == (slots.SLOT_A, slots.ROOT_SLOT)
+    assert not slots.is_confirmed()
+    slot = slots.slot_path(slots.SLOT_A)
+    assert read(slot + '/main.py') == NEW_MAIN
+    assert sorted(slots.walk(slot)) == ['main.py']
+    assert read(flash + '/main.py') == OLD_MAIN
+    # Update info reply, listening message
+    assert uplinks() == [b'2', b'4']
+
+
+def test_failed_update_keeps_running(flash):
+    async def scenario():
+        lora = LoraNet(868100000, 5, LoRa.EU868, auth=AUTH)
+        ota = LoraOTA(lora, '1.0.0')
+        radio_task, ota_task = await start(lora, ota)
+
+        await deliver(lora, ['$OTA,1,1.0.1,1700000000,*', KEYS.format('01020304')])
+        # The patch applies, but not to the file the server expects
+        await deliver(lora, host.file_frames('main.py', PATCH, post='0000000000'))
+        await deliver(lora, ['$OTA,9,{"update": 1, "new": 0, "delete": 0},*'])
+
+        # Discarded without a reset, the session is gone and the worker waits
+        # for the next frame
+        assert not ota_task.done()
+        assert ota.sessions == dict()
+        assert not ota.restart_pending
+
+        ota.stop()
+        ota_task.cancel()
+        await asyncio.wait_for(radio_task, 10)
+
+    asyncio.run(scenario())
+
+    assert slots.read_pointer() == (slots.ROOT_SLOT, None)
+    assert read(flash + '/main.py') == OLD_MAIN
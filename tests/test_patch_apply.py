@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+import host
+import diff_match_patch as dmp_module
+
+upstream = host.upstream_dmp()
+pytestmark = pytest.mark.skipif(upstream is None, reason='diff-match-patch is not installed')
+
+
+def random_edit(rng, text, alphabet):
+    # Inserts and deletes runs of text at random places
+    chars = list(text)
+    for _ in range(rng.randint(0, 15)):
+        idx = rng.randint(0, len(chars))
+        if chars and rng.random() < 0.5:
+            del chars[idx:idx + rng.randint(1, 20)]
+        else:
+            chars[idx:idx] = [rng.choice(alphabet) for _ in range(rng.randint(1, 20))]
+    return ''.join(chars)
+
+
+def cases(count, seed):
+    # Text with few distinct characters makes patch_make grow the context
+    # of a patch until it is unique, so it often covers the text inserted
+    # by the previous patch
+    rng = random.Random(seed)
+    for idx in range(count):
+        alphabet = ('ab', 'ab\n', 'abcde \n')[idx % 3]
+        old = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 500)))
+        new = random_edit(rng, old, alphabet)
+        yield old, new, upstream.patch_toText(upstream.patch_make(old, new))
+
+
+def test_exact_round_trips_patch_make():
+    dmp = dmp_module.diff_match_patch()
+    for old, new, text in cases(1000, 1):
+        patched, results = dmp.patch_applyExact(dmp.patch_fromTextCompact(text), old)
+        assert False not in results
+        assert patched == new
+
+
+def test_in_place_round_trips_patch_make():
+    dmp = dmp_module.diff_match_patch()
+    for old, new, text in cases(300, 2):
+        patched, results = dmp.patch_applyInPlace(dmp.patch_fromTextCompact(text), old)
+        assert False not in results
+        assert patched == new
+
+
+def test_exact_rejects_other_base():
+    dmp = dmp_module.diff_match_patch()
+    old = 'def main():\n    x = 1\n    return x\n'
+    new = old.replace('x = 1', 'x = 2')
+    text = upstream.patch_toText(upstream.patch_make(old, new))
+    _, results = dmp.patch_applyExact(dmp.patch_fromTextCompact(text), old.replace('x = 1', 'x = 3'))
+    assert results == [False]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Uplink collisions of a multicast group after the update manifest, with and
+# without the per-DevEUI jitter of main.py. Run it directly for a table:
+#
+#   python tests/test_reboot_jitter.py
+
+import random
+
+import host  # noqa: F401, sets up the import path
+import airtime
+from utils import eui_jitter
+
+# Windows of main.py
+REBOOT_JITTER_S = 60
+REPORT_JITTER_S = 120
+# Devices do not boot and restore their LoRaWAN session in exactly the same time
+BOOT_SPREAD_S = 2.0
+
+DR = 5
+VERSION_MSG = b'$OTA,0,1.0.1,*'
+
+
+def dev_euis(count, seed):
+    rng = random.Random(seed)
+    return ['{:016x}'.format(rng.getrandbits(64)) for _ in range(count)]
+
+
+def report_times(euis, jitter, seed):
+    # Start in s of the version report of every device, after the manifest
+    rng = random.Random(seed)
+    times = []
+    for eui in euis:
+        t = rng.uniform(0, BOOT_SPREAD_S)
+        if jitter:
+            t += eui_jitter(eui, REBOOT_JITTER_S, 'reboot') + eui_jitter(eui, REPORT_JITTER_S, 'report')
+        times.append(t)
+    return times
+
+
+def collision_rate(times, toa_s):
+    # Share of uplinks that overlap another one; every device of the group
+    # uses the same channel and DR, so an overlap loses both frames
+    times = sorted(times)
+    lost = 0
+    for idx, t in enumerate(times):
+        if (idx > 0 and t - times[idx - 1] < toa_s) or \
+           (idx + 1 < len(times) and times[idx + 1] - t < toa_s):
+            lost += 1
+    return lost / len(times)
+
+
+def simulate(count, jitter, runs = 20):
+    toa_s = airtime.uplink_time_on_air(len(VERSION_MSG), DR) / 1000
+    rates = [collision_rate(report_times(dev_euis(count, seed), jitter, seed), toa_s)
+             for seed in range(runs)]
+    return sum(rates) / len(rates)
+
+
+def test_jitter_spreads_the_version_reports():
+    assert simulate(100, False) > 0.8
+    assert simulate(100, True) < 0.15
+
+
+def test_jitter_is_fixed_per_device():
+    eui = dev_euis(1, 0)[0]
+    assert eui_jitter(eui, REBOOT_JITTER_S, 'reboot') == eui_jitter(eui, REBOOT_JITTER_S, 'reboot')
+    assert 0 <= eui_jitter(eui, REBOOT_JITTER_S, 'reboot') < REBOOT_JITTER_S
+
+
+if __name__ == '__main__':
+    print('devices  without jitter  with jitter')
+    for count in (10, 50, 100, 200, 500):
+        print('{:7d}  {:14.1%}  {:11.1%}'.format(count, simulate(count, False), simulate(count, True)))
@@ -0,0 +1,66 @@
+import host  # noqa: F401, sets up the import path
+import machine
+import watchdog
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0
+
+    def ticks_ms(self):
+        return self.now
+
+
+def make_watchdog(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(watchdog.utime, 'ticks_ms', clock.ticks_ms)
+    wdt = machine.WDT(timeout = 30000)
+    return watchdog.HardwareWatchdog(30000, wdt), wdt, clock
+
+
+def test_stalled_subsystem_stops_the_feeding(monkeypatch):
+    hwdt, wdt, clock = make_watchdog(monkeypatch)
+    hwdt.register('main', 20000)
+    hwdt.register('ota', 60000)
+
+    for _ in range(10):
+        clock.now += 5000
+        hwdt.beat('main')
+        hwdt.beat('ota')
+        assert hwdt.feed()
+    assert wdt.feeds == 10
+
+    # 'ota' stops beating, 'main' goes on
+    for _ in range(20):
+        clock.now += 5000
+        hwdt.beat('main')
+        hwdt.feed()
+    assert hwdt.stalled == 'ota'
+    assert wdt.feeds == 10 + 60000 // 5000
+
+
+def test_unregistered_subsystem_is_not_watched(monkeypatch):
+    hwdt, wdt, clock = make_watchdog(monkeypatch)
+    hwdt.register('main', 20000)
+    hwdt.register('ota', 1000)
+    hwdt.unregister('ota')
+
+    clock.now += 10000
+    hwdt.beat('main')
+    assert hwdt.feed()
+    assert hwdt.stalled is None
+
+
+def test_feeding_resumes_after_a_late_beat(monkeypatch):
+    hwdt, wdt, clock = make_watchdog(monkeypatch)
+    hwdt.register('main', 20000)
+
+    clock.now += 25000
+    assert not hwdt.feed()
+    assert hwdt.stalled == 'main'
+
+    hwdt.beat('main')
+    assert hwdt.feed()
+    assert hwdt.stalled is None
+    assert wdt.feeds == 1